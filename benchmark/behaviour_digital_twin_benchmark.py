@@ -0,0 +1,208 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "client"))
+import behaviour_digital_twin_client
+import behaviour_digital_twin_benchmark_data
+
+# Measures a running server:
+#   python behaviour_digital_twin_benchmark.py --scale 100k --reset --output results.json
+# Ingestion is measured with single-event requests (/Action/, /Reply/) for
+# the first --single-events events and with batches (/Actions/, /Replies/)
+# for the rest. /Profile/ latency is measured over --profile-requests
+# sequential requests. Calibration runs in a separate process on the
+# server's database, which publishes the fitted parameters as usual.
+
+server_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+calibration_script = """
+import json, resource, sys, time
+def peak():
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage / 1024.0 if sys.platform == "darwin" else float(usage)
+import behaviour_digital_twin_calibration
+before = peak()
+start = time.perf_counter()
+result = behaviour_digital_twin_calibration.calibrate()
+seconds = time.perf_counter() - start
+print(json.dumps({"Seconds": seconds, "PeakMemoryKB": peak(), "PeakMemoryBeforeKB": before,
+                  "Topics": {topic: {"Loss": result[topic].get("Loss"), "Iterations": result[topic].get("Iterations")} for topic in result}}))
+"""
+
+
+def default_auth_token():
+    f = open(os.path.join(server_directory, "configuration", "parameters.json"))
+    parameters = json.load(f)
+    f.close()
+    for auth in parameters["AuthenticationTokens"]:
+        if "admin" in auth["Access"]:
+            return auth["Token"]
+    return None
+
+
+def rate(count, seconds):
+    return {"Events": count, "Seconds": seconds, "Rate": count / seconds if seconds > 0 else None}
+
+
+def check(response):
+    result = response.json()
+    if result != "Success":
+        raise RuntimeError("Request failed: " + str(result))
+
+
+# Sends each item with its own request from concurrency threads
+def measure_single(send, items, concurrency):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(send, item) for item in items]:
+            future.result()
+    return rate(len(items), time.perf_counter() - start)
+
+
+# Sends the remaining items in batches, concurrency batches in flight
+def measure_batched(send, items, batch_size, concurrency):
+    start = time.perf_counter()
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        pending = set()
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+            count += len(batch)
+            pending.add(executor.submit(send, batch))
+            if len(pending) >= concurrency:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in pending:
+            future.result()
+    return rate(count, time.perf_counter() - start)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def measure_ingestion(client, auth_token, events, seed, single_events, batch_size, concurrency):
+    results = {}
+    replies = behaviour_digital_twin_benchmark_data.generate_replies(events, seed)
+    single = list(itertools.islice(replies, single_events))
+    results["Reply"] = measure_single(lambda reply: check(client.post_reply(auth_token, *reply)), single, concurrency)
+    results["Replies"] = measure_batched(lambda batch: check(client.post_replies(auth_token, batch)), replies, batch_size, concurrency)
+
+    actions = behaviour_digital_twin_benchmark_data.generate_actions(events, seed)
+    single = list(itertools.islice(actions, single_events))
+    results["Action"] = measure_single(lambda action: check(client.post_action(auth_token, *action)), single, concurrency)
+    results["Actions"] = measure_batched(lambda batch: check(client.post_actions(auth_token, batch)), actions, batch_size, concurrency)
+    return results
+
+
+def measure_profiles(client, auth_token, events, seed, requests):
+    configuration = behaviour_digital_twin_benchmark_data.load_configuration()
+    actions = behaviour_digital_twin_benchmark_data.get_actions(configuration)
+    participants = behaviour_digital_twin_benchmark_data.get_participants(events)
+    rng = random.Random("%s-profiles" % seed)
+    latencies = []
+    failures = 0
+    for i in range(requests):
+        participantId = behaviour_digital_twin_benchmark_data.participant_id(rng.randrange(participants))
+        start = time.perf_counter()
+        profile = client.get_profile(auth_token, rng.choice(actions), participantId)
+        latencies.append(time.perf_counter() - start)
+        if not isinstance(profile, dict):
+            failures += 1
+    return {"Requests": requests,
+            "Failures": failures,
+            "P50": percentile(latencies, 50),
+            "P99": percentile(latencies, 99),
+            "Mean": sum(latencies) / len(latencies) if latencies else None}
+
+
+def measure_calibration(directory):
+    process = subprocess.run([sys.executable, "-c", calibration_script], cwd=directory,
+                             capture_output=True, text=True, check=True)
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a running behaviour digital twin server")
+    parser.add_argument("--server", default=behaviour_digital_twin_client.server)
+    parser.add_argument("--auth", default=None, help="admin token, read from the server configuration if omitted")
+    parser.add_argument("--scale", choices=sorted(behaviour_digital_twin_benchmark_data.scales), default="1k")
+    parser.add_argument("--events", type=int, default=None, help="number of action events, overrides --scale")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--single-events", type=int, default=1000, help="events sent one per request")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--profile-requests", type=int, default=1000)
+    parser.add_argument("--reset", action="store_true", help="delete all data on the server first")
+    parser.add_argument("--skip-calibration", action="store_true")
+    parser.add_argument("--server-directory", default=server_directory)
+    parser.add_argument("--output", help="result file, standard output if omitted")
+    args = parser.parse_args()
+
+    auth_token = args.auth if args.auth is not None else default_auth_token()
+    events = args.events if args.events is not None else behaviour_digital_twin_benchmark_data.scales[args.scale]
+    client = behaviour_digital_twin_client.Client(args.server, pool_size=args.concurrency)
+
+    results = {"Started": datetime.now().isoformat(),
+               "Server": args.server,
+               "Events": events,
+               "Participants": behaviour_digital_twin_benchmark_data.get_participants(events),
+               "Seed": args.seed,
+               "BatchSize": args.batch_size,
+               "Concurrency": args.concurrency,
+               "Python": platform.python_version(),
+               "Platform": platform.platform()}
+    if args.reset:
+        client.delete_database(auth_token)
+    results["Ingestion"] = measure_ingestion(client, auth_token, events, args.seed, args.single_events, args.batch_size, args.concurrency)
+    results["Profile"] = measure_profiles(client, auth_token, events, args.seed, args.profile_requests)
+    if not args.skip_calibration:
+        results["Calibration"] = measure_calibration(args.server_directory)
+    client.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        f = open(args.output, "w")
+        f.write(output + "\n")
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
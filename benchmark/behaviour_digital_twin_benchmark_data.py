@@ -0,0 +1,116 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import json
+import math
+import os
+import random
+
+# Synthetic households for benchmarks. Every participant has a latent
+# flexibility that shifts both its questionnaire answers and the chance that
+# it completes an action, so calibration has a signal to fit. Replies only
+# use questions and answer codes from models.json and scales.json, and
+# actions are taken from topics.json. The same seed gives the same data.
+
+configuration_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "configuration")
+scales = {"1k": 1000, "100k": 100000, "1M": 1000000}
+actions_per_participant = 20
+
+
+def load_configuration(directory=configuration_directory):
+    configuration = {}
+    for name in ["models", "scales", "topics"]:
+        f = open(os.path.join(directory, name + ".json"))
+        configuration[name] = json.load(f)
+        f.close()
+    return configuration
+
+
+# Returns {questionnaireId: [(questionId, [answerIds in increasing value],
+# weight)]} for all questions used by the models
+def get_questions(configuration):
+    codings = {}
+    for scale in configuration["scales"]:
+        coding = sorted(scale["Coding"], key=lambda code: code["Value"])
+        codings[scale["ScaleId"]] = [code["AnswerId"] for code in coding]
+    questions = {}
+    for model in configuration["models"]:
+        questionnaire = questions.setdefault(model["QuestionnaireId"], {})
+        for section in model["Sections"]:
+            for question in model["Sections"][section]:
+                questionnaire[question["QuestionId"]] = (codings[question["Scale"]], question["Weight"])
+    return {questionnaireId: [(questionId, questions[questionnaireId][questionId][0], questions[questionnaireId][questionId][1])
+                              for questionId in sorted(questions[questionnaireId])]
+            for questionnaireId in questions}
+
+
+def get_actions(configuration):
+    actions = []
+    for topic in configuration["topics"]:
+        for action in topic["Actions"]:
+            if action not in actions:
+                actions.append(action)
+    return actions
+
+
+def get_participants(events):
+    return max(1, events // actions_per_participant)
+
+
+def participant_flexibility(seed, participant):
+    return random.Random("%s-%d" % (seed, participant)).gauss(0.0, 1.0)
+
+
+def participant_id(participant):
+    return "household-%07d" % participant
+
+
+# Yields (participantId, questionnaireId, {questionId: answerId}) with one
+# submission per participant and questionnaire
+def generate_replies(events, seed=0, configuration=None):
+    if configuration is None:
+        configuration = load_configuration()
+    questions = get_questions(configuration)
+    rng = random.Random("%s-replies" % seed)
+    for participant in range(get_participants(events)):
+        flexibility = participant_flexibility(seed, participant)
+        for questionnaireId in sorted(questions):
+            replies = {}
+            for questionId, answers, weight in questions[questionnaireId]:
+                position = (len(answers) - 1) / 2.0 + flexibility * math.copysign(1.0, weight) + rng.gauss(0.0, 1.0)
+                replies[questionId] = answers[min(len(answers) - 1, max(0, int(round(position))))]
+            yield participant_id(participant), questionnaireId, replies
+
+
+# Yields events (participantId, actionId, completed) spread evenly over the
+# participants, in random order
+def generate_actions(events, seed=0, configuration=None):
+    if configuration is None:
+        configuration = load_configuration()
+    actions = get_actions(configuration)
+    difficulty = {action: random.Random("%s-%s" % (seed, action)).gauss(0.0, 1.0) for action in actions}
+    participants = get_participants(events)
+    flexibility = [participant_flexibility(seed, participant) for participant in range(participants)]
+    rng = random.Random("%s-actions" % seed)
+    for i in range(events):
+        participant = rng.randrange(participants)
+        action = rng.choice(actions)
+        P = 1.0 / (1.0 + math.exp(-(flexibility[participant] - difficulty[action])))
+        yield participant_id(participant), action, rng.random() < P
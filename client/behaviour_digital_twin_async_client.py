@@ -0,0 +1,126 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import asyncio
+import json
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import behaviour_digital_twin_client
+from behaviour_digital_twin_client import action_submission, batches, reply_submission
+
+
+# asyncio counterpart of behaviour_digital_twin_client.Client for many
+# concurrent requests over one aiohttp connection pool. At most
+# max_concurrency requests are in flight at a time. Retries follow the
+# same rules as the synchronous client. Requires aiohttp.
+class AsyncClient:
+    def __init__(self, server=None, timeout=10.0, retries=3, backoff_factor=0.5, pool_size=100, max_concurrency=100):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for the asynchronous client")
+        if server is None:
+            server = behaviour_digital_twin_client.server
+        self.server = server
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.session = None
+
+    async def open(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size),
+                                                 timeout=self.timeout)
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def request(self, method, path, auth_token, data=None):
+        await self.open()
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, self.server + path, params={"auth": auth_token},
+                                                    data=None if data is None else json.dumps(data)) as response:
+                        if (method != "GET") or (response.status not in [502, 503, 504]) or (attempt >= self.retries):
+                            return json.loads(await response.text())
+            except aiohttp.ClientConnectorError:
+                if attempt >= self.retries:
+                    raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if (method != "GET") or (attempt >= self.retries):
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def get_questionnaire(self, auth_token, topic, language):
+        return await self.request("GET", "/Questionnaire/", auth_token, {"Topic": topic, "Language": language})
+
+    async def post_reply(self, auth_token, participantId, questionnaireId, replies):
+        return await self.request("POST", "/Reply/", auth_token, reply_submission(participantId, questionnaireId, replies))
+
+    async def post_replies(self, auth_token, submissions):
+        return await self.request("POST", "/Replies/", auth_token,
+                                  [reply_submission(participantId, questionnaireId, replies)
+                                   for participantId, questionnaireId, replies in submissions])
+
+    async def post_action(self, auth_token, participantId, actionId, completed):
+        return await self.request("POST", "/Action/", auth_token, action_submission(participantId, actionId, completed))
+
+    async def post_actions(self, auth_token, actions):
+        return await self.request("POST", "/Actions/", auth_token,
+                                  [action_submission(participantId, actionId, completed)
+                                   for participantId, actionId, completed in actions])
+
+    # Posts the batches concurrently and returns the results in order
+    async def post_actions_batched(self, auth_token, actions, batch_size=500):
+        return await asyncio.gather(*[self.post_actions(auth_token, batch) for batch in batches(actions, batch_size)])
+
+    async def post_replies_batched(self, auth_token, submissions, batch_size=500):
+        return await asyncio.gather(*[self.post_replies(auth_token, batch) for batch in batches(submissions, batch_size)])
+
+    async def get_profile(self, auth_token, actionId, participantId):
+        return await self.request("GET", "/Profile/", auth_token, {"ActionId": actionId, "ParticipantId": participantId})
+
+    async def get_profiles(self, auth_token, actionIds, participantIds):
+        return await self.request("GET", "/Profiles/", auth_token, {"ActionIds": actionIds, "ParticipantIds": participantIds})
+
+    async def force_calibration(self, auth_token):
+        return await self.request("POST", "/Calibrate/", auth_token)
+
+    async def get_calibration_status(self, auth_token, jobId=None):
+        return await self.request("GET", "/Calibrate/", auth_token, {"JobId": jobId})
+
+    async def cancel_calibration(self, auth_token, jobId):
+        return await self.request("POST", "/Calibrate/Cancel/", auth_token, {"JobId": jobId})
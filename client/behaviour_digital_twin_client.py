@@ -20,17 +20,14 @@
 
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 server = "http://127.0.0.1:5000"
 
-def get_questionnaire(auth_token, topic, language):
-    questionnaire = requests.get(url=server + "/Questionnaire/",
-                                 params={"auth":auth_token},
-                                 data=json.dumps({"Topic": topic, "Language": language})).json()
-    return questionnaire
-
 
-def post_reply(auth_token, participantId, questionnaireId, replies):
+# An optional eventId lets the server recognise and skip a replayed event
+def reply_submission(participantId, questionnaireId, replies, eventId=None):
     reply = {}
     reply["ParticipantId"] = participantId
     reply["QuestionnaireId"] = questionnaireId
@@ -41,42 +38,216 @@ def post_reply(auth_token, participantId, questionnaireId, replies):
         }
         for questionId in replies
     ]
-    result = requests.post(url=server + "/Reply/",
-                           params={"auth": auth_token},
-                           data=json.dumps(reply))
-    return result
+    if eventId is not None:
+        reply["EventId"] = eventId
+    return reply
+
+
+def action_submission(participantId, actionId, completed, eventId=None):
+    action = {"ParticipantId": participantId,
+              "ActionId": actionId,
+              "Completed": bool(completed)}
+    if eventId is not None:
+        action["EventId"] = eventId
+    return action
+
+
+def batches(items, batch_size):
+    items = list(items)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+# Keeps a pool of keep-alive connections to one server. Connection errors
+# are retried for every request, GET requests are also retried on 502, 503
+# and 504 responses, with exponential backoff between attempts. POST
+# requests are not retried once they have reached the server, so an action
+# is never recorded twice.
+class Client:
+    def __init__(self, server=server, timeout=10.0, retries=3, backoff_factor=0.5, pool_size=10):
+        self.server = server
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=[502, 503, 504],
+                      allowed_methods=["GET"],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.questionnaires = {}
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, path, auth_token, data=None, **kwargs):
+        return self.session.get(url=self.server + path, params={"auth": auth_token},
+                                data=None if data is None else json.dumps(data),
+                                timeout=self.timeout, **kwargs)
+
+    def post(self, path, auth_token, data=None):
+        return self.session.post(url=self.server + path, params={"auth": auth_token},
+                                 data=None if data is None else json.dumps(data),
+                                 timeout=self.timeout)
+
+    # Questionnaires are kept with their ETag and only downloaded again when
+    # they changed on the server
+    def get_questionnaire(self, auth_token, topic, language):
+        cached = self.questionnaires.get((topic, language))
+        headers = {} if cached is None else {"If-None-Match": cached[0]}
+        response = self.get("/Questionnaire/", auth_token, {"Topic": topic, "Language": language}, headers=headers)
+        if (response.status_code == 304) and (cached is not None):
+            return cached[1]
+        questionnaire = response.json()
+        if "ETag" in response.headers:
+            self.questionnaires[(topic, language)] = (response.headers["ETag"], questionnaire)
+        return questionnaire
+
+    def post_reply(self, auth_token, participantId, questionnaireId, replies, eventId=None):
+        return self.post("/Reply/", auth_token, reply_submission(participantId, questionnaireId, replies, eventId))
+
+    def post_replies(self, auth_token, submissions):
+        return self.post("/Replies/", auth_token,
+                         [reply_submission(participantId, questionnaireId, replies)
+                          for participantId, questionnaireId, replies in submissions])
+
+    def post_action(self, auth_token, participantId, actionId, completed, eventId=None):
+        return self.post("/Action/", auth_token, action_submission(participantId, actionId, completed, eventId))
+
+    def post_actions(self, auth_token, actions):
+        return self.post("/Actions/", auth_token,
+                         [action_submission(participantId, actionId, completed)
+                          for participantId, actionId, completed in actions])
+
+    # Posts any number of actions or replies in requests of at most
+    # batch_size entries and returns the responses
+    def post_actions_batched(self, auth_token, actions, batch_size=500):
+        return [self.post_actions(auth_token, batch) for batch in batches(actions, batch_size)]
+
+    def post_replies_batched(self, auth_token, submissions, batch_size=500):
+        return [self.post_replies(auth_token, batch) for batch in batches(submissions, batch_size)]
+
+    def get_profile(self, auth_token, actionId, participantId):
+        return self.get("/Profile/", auth_token, {"ActionId": actionId, "ParticipantId": participantId}).json()
+
+    def get_profiles(self, auth_token, actionIds, participantIds):
+        return self.get("/Profiles/", auth_token, {"ActionIds": actionIds, "ParticipantIds": participantIds}).json()
+
+    # Returns an iterator over the exported lines, which are read from the
+    # server as they arrive
+    def export_scores(self, auth_token, actionId=None, topic=None, format="NDJSON"):
+        response = self.get("/Export/", auth_token, {"ActionId": actionId, "Topic": topic, "Format": format}, stream=True)
+        return response.iter_lines(decode_unicode=True)
+
+    def force_calibration(self, auth_token):
+        return self.post("/Calibrate/", auth_token).json()
+
+    def get_calibration_status(self, auth_token, jobId=None):
+        return self.get("/Calibrate/", auth_token, {"JobId": jobId}).json()
+
+    def cancel_calibration(self, auth_token, jobId):
+        return self.post("/Calibrate/Cancel/", auth_token, {"JobId": jobId}).json()
+
+    def delete_database(self, auth_token):
+        return self.post("/Delete/", auth_token)
+
+    def rebuild_tables(self, auth_token):
+        return self.post("/Rebuild/", auth_token).json()
+
+    # Returns the response, whose JSON is the database summary without a
+    # table, otherwise one page of the table starting after the given rowid
+    # (or byte offset for "log")
+    def database_dump(self, auth_token, table=None, after=None, limit=None, start=None, end=None):
+        params = {"auth": auth_token}
+        for key, value in [("table", table), ("after", after), ("limit", limit), ("from", start), ("to", end)]:
+            if value is not None:
+                params[key] = value
+        return self.session.get(url=self.server + "/", params=params, timeout=self.timeout)
+
+    # Yields all rows of a table, fetching one page at a time
+    def database_dump_table(self, auth_token, table, limit=None, start=None, end=None):
+        after = None
+        while True:
+            page = self.database_dump(auth_token, table, after, limit, start, end).json()
+            for row in page["Rows"]:
+                yield row
+            after = page["Next"]
+            if after is None:
+                return
+
+
+# The module level functions share one Client for the server set in the
+# module variable server
+default_client = None
+
+
+def get_default_client():
+    global default_client
+    if (default_client is None) or (default_client.server != server):
+        default_client = Client(server)
+    return default_client
+
+
+def get_questionnaire(auth_token, topic, language):
+    return get_default_client().get_questionnaire(auth_token, topic, language)
+
+
+def post_reply(auth_token, participantId, questionnaireId, replies):
+    return get_default_client().post_reply(auth_token, participantId, questionnaireId, replies)
+
+
+def post_replies(auth_token, submissions):
+    return get_default_client().post_replies(auth_token, submissions)
 
 
 def post_action(auth_token, participantId, actionId, completed):
-    result = requests.post(url=server + "/Action/",
-                           params={"auth": auth_token},
-                           data=json.dumps(
-                               {"ParticipantId": participantId,
-                                "ActionId": actionId,
-                                "Completed": bool(completed)}))
-    return result
+    return get_default_client().post_action(auth_token, participantId, actionId, completed)
+
+
+def post_actions(auth_token, actions):
+    return get_default_client().post_actions(auth_token, actions)
 
 
 def get_profile(auth_token, actionId, participantId):
-    profile = requests.get(url=server + "/Profile/",
-                           params={"auth": auth_token},
-                           data=json.dumps({"ActionId": actionId,
-                                            "ParticipantId": participantId}
-                                           )).json()
-    return profile
+    return get_default_client().get_profile(auth_token, actionId, participantId)
+
+
+def get_profiles(auth_token, actionIds, participantIds):
+    return get_default_client().get_profiles(auth_token, actionIds, participantIds)
+
+
+def export_scores(auth_token, actionId=None, topic=None, format="NDJSON"):
+    return get_default_client().export_scores(auth_token, actionId, topic, format)
 
 
 def force_calibration(auth_token):
-    calibration = requests.post(url=server + "/Calibrate/",
-                                params={"auth": auth_token}).json()
-    return calibration
+    return get_default_client().force_calibration(auth_token)
+
+
+def get_calibration_status(auth_token, jobId=None):
+    return get_default_client().get_calibration_status(auth_token, jobId)
+
+
+def cancel_calibration(auth_token, jobId):
+    return get_default_client().cancel_calibration(auth_token, jobId)
 
 
 def delete_database(auth_token):
-    result = requests.post(url=server + "/Delete/", params={"auth": auth_token})
-    return result
+    return get_default_client().delete_database(auth_token)
+
+
+def rebuild_tables(auth_token):
+    return get_default_client().rebuild_tables(auth_token)
+
+
+def database_dump(auth_token, table=None, after=None, limit=None, start=None, end=None):
+    return get_default_client().database_dump(auth_token, table, after, limit, start, end)
 
 
-def database_dump(auth_token):
-    status = requests.get(url=server + "/", params={"auth": auth_token})
-    return status
+def database_dump_table(auth_token, table, limit=None, start=None, end=None):
+    return get_default_client().database_dump_table(auth_token, table, limit, start, end)
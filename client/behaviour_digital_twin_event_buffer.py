@@ -0,0 +1,140 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import json
+import sqlite3
+import uuid
+from threading import Condition, Thread
+
+import requests
+
+import behaviour_digital_twin_client
+
+
+# Queues actions and replies in a local SQLite file and posts them to the
+# server in bulk from a background thread, so events survive restarts and
+# callers never wait for the network. Every event gets an EventId when it is
+# queued; the server skips ids it has already recorded, so a batch can be
+# resent safely after a timeout. Unreachable servers and failed requests
+# are retried indefinitely with exponential backoff up to max_backoff. Only
+# events the server answers as "Invalid" are given up on: the batch is
+# split until the invalid events are isolated, and those are kept in the
+# file, marked as failed, while the rest of the batch is delivered.
+class EventBuffer:
+    def __init__(self, auth_token, path="behaviour_digital_twin_events.db", client=None,
+                 batch_size=500, flush_interval=1.0, max_backoff=60.0):
+        if client is None:
+            client = behaviour_digital_twin_client.Client()
+        self.client = client
+        self.auth_token = auth_token
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+        self.condition = Condition()
+        self.stopping = False
+        self.con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("CREATE TABLE IF NOT EXISTS events(id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT, payload TEXT, attempts INTEGER DEFAULT 0, failed INTEGER DEFAULT 0)")
+        self.thread = Thread(target=self.flusher, daemon=True)
+        self.thread.start()
+
+    def add(self, path, payload):
+        with self.condition:
+            self.con.execute("INSERT INTO events(path, payload) VALUES (?,?)", (path, json.dumps(payload)))
+
+    def add_action(self, participantId, actionId, completed):
+        self.add("/Actions/", behaviour_digital_twin_client.action_submission(participantId, actionId, completed, str(uuid.uuid4())))
+
+    def add_reply(self, participantId, questionnaireId, replies):
+        self.add("/Replies/", behaviour_digital_twin_client.reply_submission(participantId, questionnaireId, replies, str(uuid.uuid4())))
+
+    def pending(self):
+        with self.condition:
+            return self.con.execute("SELECT COUNT(*) FROM events WHERE failed=0").fetchone()[0]
+
+    def failed(self):
+        with self.condition:
+            return self.con.execute("SELECT COUNT(*) FROM events WHERE failed=1").fetchone()[0]
+
+    # Posts one batch of the oldest events sharing an endpoint. Returns the
+    # number of events taken off the queue, or raises if the server could
+    # not be reached or failed, in which case the batch is sent again later.
+    def flush_batch(self):
+        with self.condition:
+            first = self.con.execute("SELECT path FROM events WHERE failed=0 ORDER BY id LIMIT 1").fetchone()
+            if first is None:
+                return 0
+            rows = self.con.execute("SELECT id, payload FROM events WHERE failed=0 AND path=? ORDER BY id LIMIT ?",
+                                    (first[0], self.batch_size)).fetchall()
+        self.send(first[0], rows)
+        return len(rows)
+
+    # The server stores a batch completely or not at all, so a batch with an
+    # invalid event is halved until every invalid event is sent on its own.
+    # Halves already delivered are skipped by their EventIds if a transient
+    # failure makes the whole batch go out again.
+    def send(self, path, rows):
+        ids = [row[0] for row in rows]
+        marks = ",".join("?"*len(ids))
+        response = self.client.post(path, self.auth_token, [json.loads(row[1]) for row in rows])
+        answer = response.json() if response.status_code == 200 else None
+        with self.condition:
+            self.con.execute("UPDATE events SET attempts=attempts+1 WHERE id IN (" + marks + ")", ids)
+            if answer == "Success":
+                self.con.execute("DELETE FROM events WHERE id IN (" + marks + ")", ids)
+                return
+            if (answer == "Invalid") and (len(rows) == 1):
+                print("Server rejected event as invalid:" + rows[0][1])
+                self.con.execute("UPDATE events SET failed=1 WHERE id=?", (ids[0],))
+                return
+        if answer == "Invalid":
+            half = len(rows) // 2
+            self.send(path, rows[:half])
+            self.send(path, rows[half:])
+            return
+        raise RuntimeError("Server failed batch: " + response.text.strip())
+
+    # Wakes up every flush_interval and sends everything queued in batches,
+    # doubling the wait after each failure up to max_backoff
+    def flusher(self):
+        wait = self.flush_interval
+        while True:
+            with self.condition:
+                if not self.stopping:
+                    self.condition.wait(wait)
+                stopping = self.stopping
+            try:
+                while self.flush_batch() == self.batch_size:
+                    None
+                wait = self.flush_interval
+            except (requests.RequestException, RuntimeError, ValueError) as error:
+                print("Exception while flushing events:" + str(error))
+                wait = min(2 * wait, self.max_backoff)
+            if stopping:
+                return
+
+    # Stops the background thread after a last attempt to send the queued
+    # events; whatever could not be sent stays in the file for the next run
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.con.close()
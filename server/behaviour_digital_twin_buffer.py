@@ -0,0 +1,163 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import atexit
+import logging
+import time
+from threading import Thread, Condition
+
+import behaviour_digital_twin_database
+import behaviour_digital_twin_configuration
+import behaviour_digital_twin_logging
+import behaviour_digital_twin_metrics
+
+# Action events are queued in memory and written by a single writer thread in
+# batched transactions, either when a full batch is available or when the
+# flush interval has elapsed. Producers wait for room when the buffer is
+# full and fail once the timeout expires. A batch that cannot be written is
+# put back and retried with a growing delay, so producers are held back
+# while the database is unavailable; it is only dropped once the writer
+# is stopping and the last attempts failed.
+buffer = []
+buffer_condition = Condition()
+writer_thread = None
+stopping = False
+writing = False
+discards = 0
+write_attempts = 3
+max_retry_delay = 60.0
+
+
+def enabled():
+    return writer_thread is not None
+
+
+def start():
+    global writer_thread, stopping
+    with buffer_condition:
+        if writer_thread is not None:
+            return
+        stopping = False
+        writer_thread = Thread(target=writer, daemon=True)
+        writer_thread.start()
+    atexit.register(stop)
+    return
+
+
+def stop():
+    global writer_thread, stopping
+    with buffer_condition:
+        thread = writer_thread
+        stopping = True
+        buffer_condition.notify_all()
+    if thread is not None:
+        thread.join()
+    with buffer_condition:
+        writer_thread = None
+    return
+
+
+def submit(actions):
+    capacity = behaviour_digital_twin_configuration.get_parameter("ActionBufferSize")
+    timeout = behaviour_digital_twin_configuration.get_parameter("ActionBufferTimeout")
+    batch_size = behaviour_digital_twin_configuration.get_parameter("ActionBufferBatchSize")
+    if len(actions) > capacity:
+        raise RuntimeError("Action batch larger than buffer")
+    deadline = time.monotonic() + timeout
+    with buffer_condition:
+        while len(buffer) + len(actions) > capacity:
+            remaining = deadline - time.monotonic()
+            if stopping or (remaining <= 0):
+                raise RuntimeError("Action buffer full")
+            buffer_condition.wait(remaining)
+        if stopping:
+            raise RuntimeError("Action buffer stopped")
+        buffer.extend(actions)
+        if len(buffer) >= batch_size:
+            buffer_condition.notify_all()
+    return
+
+
+# Drops the actions that have not been written yet and waits for a batch
+# being written to finish, so that none are written after all data is
+# deleted. Returns the number of actions dropped.
+def discard():
+    global discards
+    with buffer_condition:
+        discarded = len(buffer)
+        del buffer[:]
+        discards += 1
+        buffer_condition.notify_all()
+        while writing:
+            buffer_condition.wait()
+    return discarded
+
+
+def writer():
+    global writing
+    batch_size = behaviour_digital_twin_configuration.get_parameter("ActionBufferBatchSize")
+    flush_interval = behaviour_digital_twin_configuration.get_parameter("ActionBufferFlushInterval")
+    failures = 0
+    while True:
+        with buffer_condition:
+            deadline = time.monotonic() + flush_interval
+            while (len(buffer) < batch_size) and not stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                buffer_condition.wait(remaining)
+            batch = buffer[:batch_size]
+            del buffer[:batch_size]
+            writing = len(batch) > 0
+            generation = discards
+            buffer_condition.notify_all()
+        if not batch:
+            if stopping:
+                return
+            continue
+
+        error = None
+        try:
+            behaviour_digital_twin_database.report_actions(batch)
+        except BaseException as exception:
+            error = exception
+        with buffer_condition:
+            writing = False
+            buffer_condition.notify_all()
+            if error is None:
+                failures = 0
+                continue
+            failures += 1
+            behaviour_digital_twin_metrics.increment("hestia_action_buffer_write_failures_total")
+            behaviour_digital_twin_logging.log(logging.ERROR, "Exception while writing %d buffered actions (attempt %d):%s" % (len(batch), failures, str(error)))
+            if generation != discards:
+                failures = 0
+                continue
+            if stopping and (failures >= write_attempts):
+                behaviour_digital_twin_metrics.increment("hestia_action_buffer_dropped_total", amount=len(batch))
+                behaviour_digital_twin_logging.log(logging.ERROR, "Dropped %d buffered actions while stopping" % len(batch))
+                continue
+            buffer[0:0] = batch
+            deadline = time.monotonic() + min(flush_interval * 2**(failures - 1), max_retry_delay)
+            while not stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                buffer_condition.wait(remaining)
@@ -18,12 +18,120 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import concurrent.futures
+import hashlib
+import json
+import math
+import multiprocessing
+import queue
+import time
+
 import behaviour_digital_twin_database
 import behaviour_digital_twin_configuration
 import behaviour_digital_twin_models
 
-def calibrate():
-    N,n = behaviour_digital_twin_database.get_all_action_response_rates()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CalibrationCancelled(Exception):
+    pass
+
+
+# Calibration reads all of its inputs in one read transaction, so that
+# replies and actions arriving during the run do not mix into it, fits every
+# topic without touching the database and publishes all parameters in a
+# single transaction at the end. The optional progress callback is called as
+# progress(topic, iteration, iterations, loss) once for every topic before
+# fitting starts and after every iteration; it may raise
+# CalibrationCancelled to abort the run before anything is published.
+# Topics whose inputs and settings have the same fingerprint as in the last
+# published run are skipped when CalibrationSkipUnchanged is set.
+# Inputs can also be passed in as topic_data, for instance from a training
+# snapshot (see behaviour_digital_twin_snapshot), and with publish=False
+# the fitted parameters are only returned.
+def calibrate(vectorized=None, progress=None, topic_data=None, publish=True):
+    settings = get_calibration_settings()
+    if vectorized is None:
+        vectorized = settings["Vectorized"]
+    stochastic = (settings["Optimizer"] != "GradientDescent") or (settings["BatchSize"] > 0)
+    if stochastic and not vectorized:
+        print("Stochastic optimizers require vectorized calibration, switching to vectorized")
+        vectorized = True
+    if vectorized and (numpy is None):
+        print("NumPy not available, falling back to scalar full-batch gradient descent")
+        vectorized = False
+        settings["Optimizer"] = "GradientDescent"
+        settings["BatchSize"] = 0
+
+    if topic_data is None:
+        topic_data = load_calibration_data()
+    else:
+        topic_data = dict(topic_data)
+    if settings["SkipUnchanged"]:
+        previous_runs = behaviour_digital_twin_database.get_calibration_runs()
+    else:
+        previous_runs = {}
+
+    result = {}
+    fingerprints = {}
+    for topic in list(topic_data):
+        fingerprints[topic] = topic_fingerprint(topic_data[topic], settings)
+        if settings["SkipUnchanged"] and (topic in previous_runs) and (previous_runs[topic]["Fingerprint"] == fingerprints[topic]):
+            result[topic] = {"Skipped": True, "Iterations": previous_runs[topic]["Iterations"], "Loss": previous_runs[topic]["Loss"]}
+            del topic_data[topic]
+
+    initial = {}
+    if settings["WarmStart"]:
+        cache = behaviour_digital_twin_database.get_parameter_cache()
+        for topic in topic_data:
+            initial[topic] = {"TPB": cache["TPB"].get(topic, [1.0]*3),
+                              "SDT": cache["SDT"].get(topic, [1.0]*4),
+                              "IAG": [cache["IAG"].get(action, 0.0) for action in topic_data[topic]["Actions"]]}
+
+    if progress is not None:
+        for topic in topic_data:
+            progress(topic, 0, settings["CalibrationIterations"], None)
+
+    if (settings["Processes"] > 1) and (len(topic_data) > 1):
+        fitted = fit_topics_in_pool(topic_data, settings, vectorized, progress, initial)
+    else:
+        fitted = {}
+        for topic in topic_data:
+            if progress is None:
+                topic_progress = None
+            else:
+                topic_progress = lambda iteration, loss, topic=topic: progress(topic, iteration, settings["CalibrationIterations"], loss)
+            fitted[topic] = fit_topic(topic_data[topic], settings, vectorized, topic_progress, initial.get(topic))
+
+    parameters = {}
+    runs = {}
+    for topic in topic_data:
+        tpb_parameters, sdt_parameters, IAG, loss, iterations, seconds = fitted[topic]
+        result[topic] = {"TPB":tpb_parameters, "SDT":sdt_parameters, "IAG":IAG, "Loss":loss, "Iterations":iterations, "Seconds":seconds}
+        parameters.update(topic_parameters(topic, tpb_parameters, sdt_parameters, IAG))
+        runs[topic] = {"Fingerprint": fingerprints[topic], "Iterations": iterations, "Loss": loss}
+
+    if publish and parameters:
+        with behaviour_digital_twin_database.transaction():
+            behaviour_digital_twin_database.set_parameters(parameters)
+            behaviour_digital_twin_database.set_calibration_runs(runs)
+    return result
+
+
+# Groups the response rates by topic and loads the inputs of every topic in
+# one read transaction
+def load_calibration_data():
+    behaviour_digital_twin_database.ensure_latest_scores()
+    with behaviour_digital_twin_database.snapshot():
+        N,n = behaviour_digital_twin_database.get_all_action_response_rates()
+        topics = group_actions_by_topic(N)
+        return {topic: load_topic_data(topic, topics[topic], N, n) for topic in topics}
+
+
+def group_actions_by_topic(N):
     topics = {}
     for actionId in N:
         topic = behaviour_digital_twin_configuration.get_topic_for_action(actionId)
@@ -31,55 +139,389 @@ def calibrate():
             topics[topic] = [actionId]
         else:
             topics[topic].append(actionId)
+    return topics
 
-    lambda_BI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorBI")
-    lambda_RAI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorRAI")
-    sigma = behaviour_digital_twin_configuration.get_parameter("ParameterPriorVariance")
-    eta = behaviour_digital_twin_configuration.get_parameter("CalibrationLearningRate")
-    iterations = behaviour_digital_twin_configuration.get_parameter("CalibrationIterations")
-    result = {}
-    for topic in topics:
+
+def get_calibration_settings():
+    return {"ImportanceFactorBI": behaviour_digital_twin_configuration.get_parameter("ImportanceFactorBI"),
+            "ImportanceFactorRAI": behaviour_digital_twin_configuration.get_parameter("ImportanceFactorRAI"),
+            "ParameterPriorVariance": behaviour_digital_twin_configuration.get_parameter("ParameterPriorVariance"),
+            "CalibrationLearningRate": behaviour_digital_twin_configuration.get_parameter("CalibrationLearningRate"),
+            "CalibrationIterations": behaviour_digital_twin_configuration.get_parameter("CalibrationIterations"),
+            "ActivationFunctionGamma": behaviour_digital_twin_configuration.get_parameter("ActivationFunctionGamma"),
+            "Vectorized": behaviour_digital_twin_configuration.get_parameter("CalibrationVectorized"),
+            "Processes": behaviour_digital_twin_configuration.get_parameter("CalibrationProcesses"),
+            "WarmStart": behaviour_digital_twin_configuration.get_parameter("CalibrationWarmStart"),
+            "SkipUnchanged": behaviour_digital_twin_configuration.get_parameter("CalibrationSkipUnchanged"),
+            "LossTolerance": behaviour_digital_twin_configuration.get_parameter("CalibrationLossTolerance"),
+            "GradientTolerance": behaviour_digital_twin_configuration.get_parameter("CalibrationGradientTolerance"),
+            "Optimizer": behaviour_digital_twin_configuration.get_parameter("CalibrationOptimizer"),
+            "BatchSize": behaviour_digital_twin_configuration.get_parameter("CalibrationBatchSize"),
+            "Momentum": behaviour_digital_twin_configuration.get_parameter("CalibrationMomentum"),
+            "AdamBeta1": behaviour_digital_twin_configuration.get_parameter("CalibrationAdamBeta1"),
+            "AdamBeta2": behaviour_digital_twin_configuration.get_parameter("CalibrationAdamBeta2"),
+            "AdamEpsilon": behaviour_digital_twin_configuration.get_parameter("CalibrationAdamEpsilon"),
+            "Seed": behaviour_digital_twin_configuration.get_parameter("CalibrationSeed")}
+
+
+# Identifies the inputs of a topic fit together with the settings that
+# affect its outcome. Snapshots carry the fingerprint of their data, which
+# is computed in the same way when the snapshot is written.
+def topic_fingerprint(data, settings):
+    keys = ["ImportanceFactorBI", "ImportanceFactorRAI", "ParameterPriorVariance", "CalibrationLearningRate",
+            "CalibrationIterations", "ActivationFunctionGamma", "LossTolerance", "GradientTolerance",
+            "Optimizer", "BatchSize", "Momentum", "AdamBeta1", "AdamBeta2", "AdamEpsilon", "Seed"]
+    content = json.dumps([data_fingerprint(data), [settings[key] for key in keys]])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def data_fingerprint(data):
+    if "Fingerprint" in data:
+        return data["Fingerprint"]
+    content = json.dumps([data["Actions"], data["ActionIndex"], data["Rate"], data["Scores"]])
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# Returns the fitted parameters, the final loss, the number of iterations
+# and the fitting time in seconds
+def fit_topic(data, settings, vectorized, progress=None, initial=None):
+    start = time.perf_counter()
+    if vectorized:
+        fitted = fit_topic_vectorized(data, settings, progress, initial)
+    else:
+        fitted = fit_topic_scalar(data, settings, progress, initial)
+    return fitted + (time.perf_counter() - start,)
+
+
+# A fit stops early once the gradient norm falls below GradientTolerance or
+# the loss changes by less than LossTolerance relative to the previous
+# iteration. A tolerance of 0 disables the criterion.
+def converged(settings, previous_loss, loss, gradient_norm):
+    if gradient_norm < settings["GradientTolerance"]:
+        return True
+    if (previous_loss is not None) and (abs(previous_loss - loss) < settings["LossTolerance"] * abs(previous_loss)):
+        return True
+    return False
+
+
+# Topics are independent of each other, so they can be fitted in separate
+# processes. Each worker receives the topic's snapshot and the settings and
+# runs the same fit as a sequential calibration. Workers are spawned rather
+# than forked as the service process runs several threads. They send their
+# progress at most every pool_progress_interval seconds over a queue, which
+# is passed on to the progress callback. The callback is also called with
+# the last known state of a running topic when no update arrived, so that it
+# can cancel the run; running fits then stop at their next iteration.
+pool_progress_interval = 0.5
+pool_progress_queue = None
+pool_cancel_event = None
+
+
+def initialise_pool_worker(progress_queue, cancel_event):
+    global pool_progress_queue, pool_cancel_event
+    pool_progress_queue = progress_queue
+    pool_cancel_event = cancel_event
+
+
+def fit_topic_in_worker(topic, data, settings, vectorized, initial):
+    reported = [0.0]
+    def progress(iteration, loss):
+        if pool_cancel_event.is_set():
+            raise CalibrationCancelled()
+        now = time.monotonic()
+        if now - reported[0] >= pool_progress_interval:
+            reported[0] = now
+            pool_progress_queue.put((topic, iteration, loss))
+    return fit_topic(data, settings, vectorized, progress, initial)
+
+
+def fit_topics_in_pool(topic_data, settings, vectorized, progress=None, initial={}):
+    iterations = settings["CalibrationIterations"]
+    fitted = {}
+    state = {topic: (0, None) for topic in topic_data}
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    cancel_event = context.Event()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(settings["Processes"], len(topic_data)), mp_context=context,
+                                                initializer=initialise_pool_worker, initargs=(progress_queue, cancel_event)) as executor:
+        futures = {executor.submit(fit_topic_in_worker, topic, topic_data[topic], settings, vectorized, initial.get(topic)): topic for topic in topic_data}
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=pool_progress_interval, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    topic = futures[future]
+                    fitted[topic] = future.result()
+                    state[topic] = (iterations, fitted[topic][3])
+                    if progress is not None:
+                        progress(topic, iterations, iterations, fitted[topic][3])
+                updated = set()
+                while True:
+                    try:
+                        topic, iteration, loss = progress_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if (topic not in fitted) and (iteration > state[topic][0]):
+                        state[topic] = (iteration, loss)
+                        updated.add(topic)
+                if progress is not None:
+                    for topic in updated:
+                        if topic not in fitted:
+                            progress(topic, state[topic][0], iterations, state[topic][1])
+                    if pending and not updated:
+                        topic = futures[next(iter(pending))]
+                        progress(topic, state[topic][0], iterations, state[topic][1])
+        except BaseException:
+            cancel_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return fitted
+
+
+def topic_parameters(topic, tpb_parameters, sdt_parameters, IAG):
+    parameters = {"wA_%s"%topic:tpb_parameters[0], "wSN_%s"%topic:tpb_parameters[1], "wPBC_%s"%topic:tpb_parameters[2],
+                  "wInt_%s"%topic:sdt_parameters[0], "wId_%s"%topic:sdt_parameters[1], "wIntro_%s"%topic:sdt_parameters[2], "wExt_%s"%topic:sdt_parameters[3]}
+    for action in IAG:
+        parameters["IAG_%s"%action] = IAG[action]
+    return parameters
+
+
+# Loads the section scores of every participant/action pair that contributes
+# to the gradient of a topic, so that fitting never has to go back to the
+# database. Pairs are grouped by action, in the order of the response rate
+# dicts. Scores are looked up once per participant as they are shared by all
+# actions of the topic.
+def load_topic_data(topic, actions, N, n):
+    participant_scores = {}
+    action_index = []
+    rates = []
+    scores = []
+    skipped = 0
+    for a, action in enumerate(actions):
+        for participant in N[action]:
+            NN = float(N[action][participant])
+            nn = float(n[action][participant])
+            if (NN>1) and (nn>0) and (nn<NN):
+                if participant not in participant_scores:
+                    tpb = behaviour_digital_twin_database.get_latest_replies("TPB", topic, participant)
+                    sdt = behaviour_digital_twin_database.get_latest_replies("SDT", topic, participant)
+                    participant_scores[participant] = section_scores(tpb, sdt)
+                if participant_scores[participant] is None:
+                    skipped += 1
+                    continue
+                action_index.append(a)
+                rates.append(nn/NN)
+                scores.append(participant_scores[participant])
+    report_skipped_pairs(topic, skipped)
+    return {"Actions": list(actions),
+            "ActionIndex": action_index,
+            "Rate": rates,
+            "Scores": scores}
+
+
+# The scores of a participant in the order the fits use them, read from the
+# sections as models.TPB and models.SDT do. Participants who have reported
+# actions but not completed both questionnaires have no scores; their pairs
+# are left out of the fit, both here and in training snapshots.
+def section_scores(tpb, sdt):
+    if (tpb is None) or (sdt is None):
+        return None
+    return [tpb["BehaviouralBeliefs"], tpb["ControlBeliefs"], tpb["NormativeBeliefs"],
+            sdt["Intrinsic"], sdt["Identified"], sdt["Introjected"], sdt["External"]]
+
+
+# Training snapshots store the scores once per participant, with the
+# participant of every pair in "Participant"
+def pair_scores(data):
+    if "Participant" in data:
+        return numpy.asarray(data["Scores"])[numpy.asarray(data["Participant"])]
+    return data["Scores"]
+
+
+def report_skipped_pairs(topic, skipped):
+    if skipped > 0:
+        print("Calibration of topic " + str(topic) + " skips " + str(skipped) + " pairs of participants without scores")
+
+
+# The fits minimise the squared deviation of the predicted from the observed
+# response rate, weighted by the inverse binomial variance, plus a Gaussian
+# prior around 1.0 on the TPB and SDT weights. They start from the given
+# initial parameters, or from the prior, and return the fitted parameters,
+# the loss of the last iteration and the number of updates made.
+def fit_topic_scalar(data, settings, progress=None, initial=None):
+    lambda_BI = settings["ImportanceFactorBI"]
+    lambda_RAI = settings["ImportanceFactorRAI"]
+    sigma = settings["ParameterPriorVariance"]
+    eta = settings["CalibrationLearningRate"]
+    iterations = settings["CalibrationIterations"]
+    gamma = settings["ActivationFunctionGamma"]
+    actions = data["Actions"]
+    scores = pair_scores(data)
+
+    if initial is None:
         tpb_parameters = [1.0]*3
         sdt_parameters = [1.0]*4
-        IAG = {}
-        for action in topics[topic]:
-            IAG[action] = 0.0
-
-        for iteration in range(iterations):
-            dTPB = [0.0]*len(tpb_parameters)
-            for i in range(len(dTPB)):
-                dTPB[i] = 2 * (tpb_parameters[i] - 1.0) / sigma
-            dSDT = [0.0]*len(sdt_parameters)
-            for i in range(len(dSDT)):
-                dSDT[i] = 2 * (sdt_parameters[i] - 1.0) / sigma
-            for action in topics[topic]:
-                dIAG = 0
-                for participant in N[action]:
-                    NN = float(N[action][participant])
-                    nn = float(n[action][participant])
-                    if (NN>1) and (nn>0) and (nn<NN):
-                        variance = (nn/NN)*(1.0 - (nn/NN))
-
-                        P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext = behaviour_digital_twin_models.likelihoodOfBehaviour(action, participant, topic, tpb_parameters, sdt_parameters, IAG[action])
-                        omega = 2*((nn/NN) - P)*dP/variance
-                        dIAG += omega
-                        dTPB[0] -= lambda_BI*omega*A
-                        dTPB[1] -= lambda_BI*omega*SN
-                        dTPB[2] -= lambda_BI*omega*PBC
-                        dSDT[0] -= lambda_RAI*2*omega*Rint
-                        dSDT[1] -= lambda_RAI*omega*Rid
-                        dSDT[2] -= -lambda_RAI*omega*Rintro
-                        dSDT[3] -= -lambda_RAI*2*omega*Rext
-
-                IAG[action] -= eta * dIAG
-            for i in range(3):
-                tpb_parameters[i] -= eta * dTPB[i]
-            for i in range(4):
-                sdt_parameters[i] -= eta * dSDT[i]
-
-        result[topic] = {"TPB":tpb_parameters, "SDT":sdt_parameters, "IAG":IAG}
-        behaviour_digital_twin_database.set_parameters({"wA_%s"%topic:tpb_parameters[0], "wSN_%s"%topic:tpb_parameters[1], "wPBC_%s"%topic:tpb_parameters[2]})
-        behaviour_digital_twin_database.set_parameters({"wInt_%s"%topic:sdt_parameters[0], "wId_%s"%topic:sdt_parameters[1], "wIntro_%s"%topic:sdt_parameters[2], "wExt_Flexibility":sdt_parameters[3] })
-        behaviour_digital_twin_database.set_parameters({"IAG_%s"%action:IAG[action] for action in topics[topic] })
+        IAG = [0.0]*len(actions)
+    else:
+        tpb_parameters = list(initial["TPB"])
+        sdt_parameters = list(initial["SDT"])
+        IAG = list(initial["IAG"])
 
-    return result
+    loss = None
+    iteration = 0
+    while iteration < iterations:
+        previous_loss = loss
+        dTPB = [0.0]*len(tpb_parameters)
+        loss = 0.0
+        for i in range(len(dTPB)):
+            dTPB[i] = 2 * (tpb_parameters[i] - 1.0) / sigma
+            loss += (tpb_parameters[i] - 1.0)**2 / sigma
+        dSDT = [0.0]*len(sdt_parameters)
+        for i in range(len(dSDT)):
+            dSDT[i] = 2 * (sdt_parameters[i] - 1.0) / sigma
+            loss += (sdt_parameters[i] - 1.0)**2 / sigma
+        dIAG = [0]*len(actions)
+        for k in range(len(data["Rate"])):
+            a = data["ActionIndex"][k]
+            rate = data["Rate"][k]
+            A, SN, PBC, Rint, Rid, Rintro, Rext = scores[k]
+            variance = rate*(1.0 - rate)
+
+            BI = behaviour_digital_twin_models.behaviouralIntention(A, SN, PBC, tpb_parameters)
+            RAI = behaviour_digital_twin_models.relativeAutonomyIndex(Rint, Rid, Rintro, Rext, sdt_parameters)
+            P, dP = behaviour_digital_twin_models.probabilityOfBehaviour(BI, RAI, IAG[a], lambda_BI, lambda_RAI, gamma)
+            omega = 2*(rate - P)*dP/variance
+            loss += (rate - P)**2/variance
+            dIAG[a] += omega
+            dTPB[0] -= lambda_BI*omega*A
+            dTPB[1] -= lambda_BI*omega*SN
+            dTPB[2] -= lambda_BI*omega*PBC
+            dSDT[0] -= lambda_RAI*2*omega*Rint
+            dSDT[1] -= lambda_RAI*omega*Rid
+            dSDT[2] -= -lambda_RAI*omega*Rintro
+            dSDT[3] -= -lambda_RAI*2*omega*Rext
+
+        gradient_norm = math.sqrt(sum(d*d for d in dTPB) + sum(d*d for d in dSDT) + sum(d*d for d in dIAG))
+        if converged(settings, previous_loss, loss, gradient_norm):
+            break
+        for a in range(len(actions)):
+            IAG[a] -= eta * dIAG[a]
+        for i in range(3):
+            tpb_parameters[i] -= eta * dTPB[i]
+        for i in range(4):
+            sdt_parameters[i] -= eta * dSDT[i]
+        iteration += 1
+        if progress is not None:
+            progress(iteration, loss)
+
+    return tpb_parameters, sdt_parameters, {action: IAG[a] for a, action in enumerate(actions)}, loss, iteration
+
+
+# Returns the parameter update for a gradient, given as one vector over the
+# TPB weights, the SDT weights and the IAG values. The optimizer state is
+# kept in a dict between iterations.
+def optimizer_step(settings, state, gradient):
+    eta = settings["CalibrationLearningRate"]
+    if settings["Optimizer"] == "GradientDescent":
+        return eta * gradient
+    elif settings["Optimizer"] == "Momentum":
+        if "Velocity" not in state:
+            state["Velocity"] = numpy.zeros_like(gradient)
+        state["Velocity"] = settings["Momentum"] * state["Velocity"] + gradient
+        return eta * state["Velocity"]
+    elif settings["Optimizer"] == "Adam":
+        beta1 = settings["AdamBeta1"]
+        beta2 = settings["AdamBeta2"]
+        if "Step" not in state:
+            state["Step"] = 0
+            state["Mean"] = numpy.zeros_like(gradient)
+            state["Variance"] = numpy.zeros_like(gradient)
+        state["Step"] += 1
+        state["Mean"] = beta1 * state["Mean"] + (1.0 - beta1) * gradient
+        state["Variance"] = beta2 * state["Variance"] + (1.0 - beta2) * gradient**2
+        mean = state["Mean"] / (1.0 - beta1**state["Step"])
+        variance = state["Variance"] / (1.0 - beta2**state["Step"])
+        return eta * mean / (numpy.sqrt(variance) + settings["AdamEpsilon"])
+    raise ValueError("Unknown optimizer " + str(settings["Optimizer"]))
+
+
+# Batched equivalent of fit_topic_scalar. Within an iteration the IAG of an
+# action only depends on its own participants, so all actions can be updated
+# at once without changing the result. With a BatchSize above 0 every
+# iteration estimates the gradient and the loss from that many
+# participant/action pairs, drawn with replacement from a generator seeded
+# with Seed, scaled up to the whole population.
+def fit_topic_vectorized(data, settings, progress=None, initial=None):
+    lambda_BI = settings["ImportanceFactorBI"]
+    lambda_RAI = settings["ImportanceFactorRAI"]
+    sigma = settings["ParameterPriorVariance"]
+    iterations = settings["CalibrationIterations"]
+    gamma = settings["ActivationFunctionGamma"]
+    actions = data["Actions"]
+    action_index = numpy.asarray(data["ActionIndex"], dtype=int)
+    rate = numpy.asarray(data["Rate"], dtype=float)
+    variance = rate*(1.0 - rate)
+    scores = numpy.asarray(pair_scores(data), dtype=float).reshape(-1, 7)
+    X_TPB = scores[:, :3]
+    X_SDT = scores[:, 3:]
+    sdt_signs = numpy.array([2.0, 1.0, -1.0, -2.0])
+
+    if initial is None:
+        tpb_parameters = numpy.ones(3)
+        sdt_parameters = numpy.ones(4)
+        IAG = numpy.zeros(len(actions))
+    else:
+        tpb_parameters = numpy.array(initial["TPB"], dtype=float)
+        sdt_parameters = numpy.array(initial["SDT"], dtype=float)
+        IAG = numpy.array(initial["IAG"], dtype=float)
+
+    pairs = len(rate)
+    batch_size = settings["BatchSize"]
+    rng = numpy.random.default_rng(settings["Seed"])
+    state = {}
+
+    loss = None
+    iteration = 0
+    while iteration < iterations:
+        previous_loss = loss
+        if (batch_size > 0) and (batch_size < pairs):
+            batch = rng.integers(0, pairs, size=batch_size)
+            scale = pairs / batch_size
+            b_index = action_index[batch]
+            b_rate = rate[batch]
+            b_variance = variance[batch]
+            b_TPB = X_TPB[batch]
+            b_SDT = X_SDT[batch]
+        else:
+            scale = 1.0
+            b_index = action_index
+            b_rate = rate
+            b_variance = variance
+            b_TPB = X_TPB
+            b_SDT = X_SDT
+        BI = b_TPB @ tpb_parameters / 3.0
+        RAI = b_SDT @ (sdt_signs * sdt_parameters) / 6.0
+        beta = lambda_BI*BI + lambda_RAI*RAI - IAG[b_index]
+        P = 1.0 / (1 + numpy.exp(-beta/gamma))
+        dP = P * (1.0 - P) / gamma
+        omega = 2*(b_rate - P)*dP/b_variance
+        if scale != 1.0:
+            omega *= scale
+        loss = float(numpy.sum((tpb_parameters - 1.0)**2) / sigma + numpy.sum((sdt_parameters - 1.0)**2) / sigma + scale * numpy.sum((b_rate - P)**2/b_variance))
+
+        dTPB = 2 * (tpb_parameters - 1.0) / sigma - lambda_BI * (omega @ b_TPB)
+        dSDT = 2 * (sdt_parameters - 1.0) / sigma - lambda_RAI * sdt_signs * (omega @ b_SDT)
+        dIAG = numpy.bincount(b_index, weights=omega, minlength=len(actions))
+
+        gradient_norm = math.sqrt(float(dTPB @ dTPB + dSDT @ dSDT + dIAG @ dIAG))
+        if converged(settings, previous_loss, loss, gradient_norm):
+            break
+        step = optimizer_step(settings, state, numpy.concatenate([dTPB, dSDT, dIAG]))
+        tpb_parameters -= step[:3]
+        sdt_parameters -= step[3:7]
+        IAG -= step[7:]
+        iteration += 1
+        if progress is not None:
+            progress(iteration, loss)
+
+    return tpb_parameters.tolist(), sdt_parameters.tolist(), {action: float(IAG[a]) for a, action in enumerate(actions)}, loss, iteration
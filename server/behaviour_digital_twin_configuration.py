@@ -1,146 +1,249 @@
-# Copyright 2023 Munster Technological University, Ireland
-#
-# Permission is hereby granted, free of charge, to any person obtaining a
-# copy of this software and associated documentation files (the “Software”),
-# to deal in the Software without restriction, including without limitation
-# the rights to use, copy, modify, merge, publish, distribute, sublicense,
-# and/or sell copies of the Software, and to permit persons to whom the
-# Software is furnished to do so, subject to the following conditions:
-#
-# The above copyright notice and this permission notice shall be included in
-# all copies or substantial portions of the Software.
-#
-# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
-# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
-# DEALINGS IN THE SOFTWARE.
-
-
-import json
-import math
-
-
-f = open("configuration/parameters.json")
-parameters_file = json.load(f)
-f.close()
-def get_parameter(key):
-    value = parameters_file[key]
-    return value
-
-
-def auth_token_valid(token, access):
-    auth_tokens = get_parameter("AuthenticationTokens")
-    for auth in auth_tokens:
-        if auth["Token"] == token:
-            user = auth["User"]
-            if access in auth["Access"]:
-                print("Request authenticated for user ", user)
-                return True
-    return False
-
-
-def get_questionnaire(topic, language):
-    f = open("configuration/topics.json")
-    topics_file = json.load(f)
-    f.close()
-    filename = None
-    for t in topics_file:
-        if t["Topic"] == topic:
-            for q in t["Questionnaires"]:
-                if q["Language"] == language:
-                    filename = q["File"]
-                    break
-            break
-    if filename is None:
-        questionnaire = None
-    else:
-        f = open("questionnaires/" + filename)
-        questionnaire = json.load(f)
-        f.close()
-    return questionnaire
-
-
-def get_questionnaireIds_for_topic(model, topicId):
-    questionnairesForModel = set()
-    f = open("configuration/models.json")
-    models_file = json.load(f)
-    f.close()
-    for m in models_file:
-        if m["Model"]==model:
-            questionnairesForModel.add(m["QuestionnaireId"])
-    questionnaireIds = set()
-    f = open("configuration/topics.json")
-    topics_file = json.load(f)
-    f.close()
-    for t in topics_file:
-        if t["Topic"] == topicId:
-            for q in t["Questionnaires"]:
-                filename = q["File"]
-                f = open("questionnaires/" + filename)
-                questionnaire = json.load(f)
-                f.close()
-                if questionnaire["QuestionnaireId"] in questionnairesForModel:
-                    questionnaireIds.add(questionnaire["QuestionnaireId"])
-    return questionnaireIds
-
-
-def get_scales():
-    f = open("configuration/scales.json")
-    scales_file = json.load(f)
-    f.close()
-    scales = {}
-    for scale in scales_file:
-        scaleId = scale["ScaleId"]
-        scales[scaleId] = {}
-        for code in scale["Coding"]:
-            scales[scaleId][code["AnswerId"]] = code["Value"]
-    return scales
-
-
-def extract_complete_set(model, questionnaire, question_answer_pairs):
-    scales = get_scales()
-    f = open("configuration/models.json")
-    models_file = json.load(f)
-    f.close()
-    for m in models_file:
-        if (m["Model"]==model) and (m["QuestionnaireId"]==questionnaire):
-            sections = {}
-            model_valid = True
-            for section in m["Sections"]:
-                sections[section] = 0
-                total_weight = 0
-                for question in m["Sections"][section]:
-                    if question["QuestionId"] in question_answer_pairs:
-                        id = question["QuestionId"]
-                        answer = question_answer_pairs[id]
-                        scale = question["Scale"]
-                        weight = question["Weight"]
-                        total_weight += abs(weight)
-                        sections[section] += weight * scales[scale][answer]
-                    else:
-                        model_valid = False
-                        break
-                if total_weight==0:
-                    model_valid = False
-                else:
-                    sections[section] /= total_weight
-                if not model_valid:
-                    break
-            if model_valid:
-                return sections
-    return None
-
-
-def get_topic_for_action(action):
-    f = open("configuration/topics.json")
-    topics_file = json.load(f)
-    f.close()
-    for topic in topics_file:
-        if action in topic["Actions"]:
-            return topic["Topic"]
-        if topic["DefaultTopic"]:
-            default = topic["Topic"]
-    return default
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+from threading import Lock
+
+
+f = open("configuration/parameters.json")
+parameters_file = json.load(f)
+f.close()
+def get_parameter(key):
+    value = parameters_file[key]
+    return value
+
+
+def auth_token_valid(token, access):
+    auth_tokens = get_parameter("AuthenticationTokens")
+    for auth in auth_tokens:
+        if auth["Token"] == token:
+            user = auth["User"]
+            if access in auth["Access"]:
+                print("Request authenticated for user ", user)
+                return True
+    return False
+
+
+# The topics, models, scales and questionnaire files are compiled once into
+# indexed lookup tables. The registry is replaced as a whole whenever one of
+# the files changes on disk, so readers always see a consistent version.
+registry = None
+registry_version = 0
+registry_checked = 0.0
+registry_check_interval = 1.0
+registry_lock = Lock()
+
+
+def load_registry():
+    files = {}
+    def load(filename):
+        files[filename] = os.stat(filename).st_mtime_ns
+        f = open(filename)
+        content = json.load(f)
+        f.close()
+        return content
+
+    topics_file = load("configuration/topics.json")
+    models_file = load("configuration/models.json")
+    scales_file = load("configuration/scales.json")
+
+    scales = {}
+    for scale in scales_file:
+        scaleId = scale["ScaleId"]
+        scales[scaleId] = {}
+        for code in scale["Coding"]:
+            scales[scaleId][code["AnswerId"]] = code["Value"]
+
+    questionnairesForModel = {}
+    section_plans = {}
+    for m in models_file:
+        questionnairesForModel.setdefault(m["Model"], set()).add(m["QuestionnaireId"])
+        plan = []
+        for section in m["Sections"]:
+            questions = []
+            total_weight = 0
+            for question in m["Sections"][section]:
+                questions.append((question["QuestionId"], question["Scale"], question["Weight"]))
+                total_weight += abs(question["Weight"])
+            plan.append((section, questions, total_weight))
+        section_plans.setdefault((m["Model"], m["QuestionnaireId"]), []).append(plan)
+
+    topic_for_action = {}
+    default_topic = None
+    questionnaires = {}
+    questionnaireIdsForTopic = {}
+    answer_codes = {}
+    for t in topics_file:
+        for action in t["Actions"]:
+            topic_for_action.setdefault(action, t["Topic"])
+        if t["DefaultTopic"]:
+            default_topic = t["Topic"]
+        for q in t["Questionnaires"]:
+            questionnaire = load("questionnaires/" + q["File"])
+            questionnaires.setdefault((t["Topic"], q["Language"]), questionnaire)
+            for question in questionnaire["Questionnaire"]:
+                answer_codes.setdefault((questionnaire["QuestionnaireId"], question["QuestionId"]), set()).update(
+                    answer["AnswerId"] for answer in question["Answers"])
+            questionnaireIdsForTopic.setdefault(t["Topic"], set()).add(questionnaire["QuestionnaireId"])
+
+    # Scored questions only accept the codes of their scale, the other
+    # questions the answers their questionnaire offers
+    for m in models_file:
+        for section in m["Sections"]:
+            for question in m["Sections"][section]:
+                answer_codes[(m["QuestionnaireId"], question["QuestionId"])] = set(scales.get(question["Scale"], {}))
+
+    questionnaire_ids = {}
+    for model in questionnairesForModel:
+        for topic in questionnaireIdsForTopic:
+            questionnaire_ids[(model, topic)] = frozenset(questionnaireIdsForTopic[topic] & questionnairesForModel[model])
+
+    # Questionnaires are served as prepared bytes, once plain and once
+    # gzipped, each with a strong ETag derived from its content
+    questionnaire_responses = {}
+    for key in questionnaires:
+        body = json.dumps(questionnaires[key], sort_keys=True, separators=(",", ":")).encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        questionnaire_responses[key] = {"Body": body,
+                                        "ETag": digest,
+                                        "Gzip": gzip.compress(body, mtime=0),
+                                        "GzipETag": digest + "-gzip"}
+
+    # Identifies the scoring rules, so that scores materialised with other
+    # rules can be recognised as stale
+    scoring = json.dumps([sorted([list(key), section_plans[key]] for key in section_plans),
+                          scales,
+                          sorted([list(key), sorted(questionnaire_ids[key])] for key in questionnaire_ids)], sort_keys=True)
+    scoring_fingerprint = hashlib.sha256(scoring.encode("utf-8")).hexdigest()
+
+    global registry_version
+    registry_version += 1
+    return {"Version": registry_version,
+            "Files": files,
+            "Scales": scales,
+            "SectionPlans": section_plans,
+            "TopicForAction": topic_for_action,
+            "DefaultTopic": default_topic,
+            "Questionnaires": questionnaires,
+            "QuestionnaireResponses": questionnaire_responses,
+            "QuestionnaireIds": questionnaire_ids,
+            "AnswerCodes": answer_codes,
+            "ScoringFingerprint": scoring_fingerprint}
+
+
+def registry_changed(config):
+    for filename in config["Files"]:
+        try:
+            if os.stat(filename).st_mtime_ns != config["Files"][filename]:
+                return True
+        except OSError:
+            return True
+    return False
+
+
+def get_registry():
+    global registry, registry_checked
+    now = time.monotonic()
+    if (registry is None) or (now - registry_checked > registry_check_interval):
+        with registry_lock:
+            if registry is None:
+                registry = load_registry()
+            elif registry_changed(registry):
+                try:
+                    registry = load_registry()
+                    print("Configuration reloaded, version ", registry["Version"])
+                except BaseException as error:
+                    print("Exception while reloading configuration:" + str(error))
+            registry_checked = now
+    return registry
+
+
+def get_questionnaire(topic, language):
+    return get_registry()["Questionnaires"].get((topic, language))
+
+
+def get_questionnaire_response(topic, language):
+    return get_registry()["QuestionnaireResponses"].get((topic, language))
+
+
+def answer_valid(questionnaireId, questionId, answerId):
+    return answerId in get_registry()["AnswerCodes"].get((questionnaireId, questionId), ())
+
+
+def get_questionnaireIds_for_topic(model, topicId):
+    return get_registry()["QuestionnaireIds"].get((model, topicId), frozenset())
+
+
+def get_models_and_topics_for_questionnaireId(questionnaireId):
+    questionnaire_ids = get_registry()["QuestionnaireIds"]
+    return [key for key in questionnaire_ids if questionnaireId in questionnaire_ids[key]]
+
+
+def get_scoring_fingerprint():
+    return get_registry()["ScoringFingerprint"]
+
+
+def get_scales():
+    return get_registry()["Scales"]
+
+
+# Answers that are not codes of the question's scale leave the set
+# incomplete, like missing answers, so that stored replies can always be
+# scored with the current rules
+def score_sections(plan, scales, question_answer_pairs):
+    sections = {}
+    for section, questions, total_weight in plan:
+        if total_weight==0:
+            return None
+        value = 0
+        for id, scale, weight in questions:
+            if id not in question_answer_pairs:
+                return None
+            answer = question_answer_pairs[id]
+            if answer not in scales.get(scale, {}):
+                return None
+            value += weight * scales[scale][answer]
+        sections[section] = value / total_weight
+    return sections
+
+
+def extract_complete_set(model, questionnaire, question_answer_pairs):
+    config = get_registry()
+    for plan in config["SectionPlans"].get((model, questionnaire), []):
+        sections = score_sections(plan, config["Scales"], question_answer_pairs)
+        if sections is not None:
+            return sections
+    return None
+
+
+def get_topic_for_action(action):
+    config = get_registry()
+    return config["TopicForAction"].get(action, config["DefaultTopic"])
+
+
+def get_actions_for_topic(topic):
+    topic_for_action = get_registry()["TopicForAction"]
+    return [action for action in topic_for_action if topic_for_action[action] == topic]
@@ -19,131 +19,588 @@
 # DEALINGS IN THE SOFTWARE.
 
 import sqlite3
+import json
 import time
 import behaviour_digital_twin_configuration
+import behaviour_digital_twin_logging
+import behaviour_digital_twin_metrics
 import os
-from datetime import datetime
+import threading
+from contextlib import contextmanager
 
-def get_status():
-    result = {}
-    try:
-        result["Databases"] = []
-        con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-        cur = con.cursor()
-        for row in cur.execute("SELECT name FROM sqlite_master"):
-            result["Databases"].append(row[0])
-    except:
-        None
-    try:
-        result["Parameters"] = []
-        for row in cur.execute("SELECT timestamp, key, value FROM parameters"):
-            result["Parameters"].append({"timestamp": row[0],
-                                         "key":row[1],
-                                         "value":row[2]})
-    except:
-        None
-    try:
-        result["Actions"] = []
-        for row in cur.execute("SELECT timestamp, participantId, actionId, actionCompleted FROM actions"):
-            result["Actions"].append({"timestamp": row[0],
-                                      "participantId":row[1],
-                                      "actionId":row[2],
-                                      "actionCompleted":row[3]})
-    except:
-        None
+database_file = "./data/Hestia_BehaviourDigitalTwin_data.db"
+connection_pool_size = 8
+query_chunk_size = 500
+seconds_per_day = 86400
+
+# Connections are kept open and handed out from a per-process pool. A thread
+# that already holds a connection gets the same one back, so nested calls
+# share its transaction. The schema is created or migrated once per process
+# before the first connection is used.
+connection_pool = []
+connection_pool_pid = None
+connection_pool_lock = threading.Lock()
+connection_local = threading.local()
+schema_lock = threading.Lock()
+write_lock = threading.Lock()
+schema_pid = None
+
+
+def open_connection():
+    con = sqlite3.connect(database_file, timeout=30, isolation_level=None, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA cache_size=-65536")
+    con.execute("PRAGMA temp_store=MEMORY")
+    return con
+
+
+def acquire_connection():
+    global connection_pool, connection_pool_pid
+    with connection_pool_lock:
+        if connection_pool_pid != os.getpid():
+            # Connections inherited from a parent process must not be used
+            connection_pool = []
+            connection_pool_pid = os.getpid()
+        if connection_pool:
+            return connection_pool.pop()
+    return open_connection()
+
+
+def release_connection(con):
+    if con.in_transaction:
+        con.execute("ROLLBACK")
+    with connection_pool_lock:
+        if (connection_pool_pid == os.getpid()) and (len(connection_pool) < connection_pool_size):
+            connection_pool.append(con)
+            return
+    con.close()
+
+
+@contextmanager
+def connection():
+    held = getattr(connection_local, "held", None)
+    if (held is not None) and (held[0] == os.getpid()):
+        yield held[1]
+        return
+    if schema_pid != os.getpid():
+        initialise_database()
+    con = acquire_connection()
+    connection_local.held = (os.getpid(), con)
     try:
-        result["Replies"] = []
-        for row in cur.execute("SELECT timestamp, participantId, questionnaireId, questionId, answerId FROM replies"):
-            result["Replies"].append({"timestamp":row[0],
-                                      "participantId":row[1],
-                                      "questionnaireId":row[2],
-                                      "questionId":row[3],
-                                      "answerId":row[4]})
-    except:
-        None
+        yield con
+    finally:
+        connection_local.held = None
+        release_connection(con)
+
+
+@contextmanager
+def snapshot():
+    with connection() as con:
+        if con.in_transaction:
+            yield con
+            return
+        con.execute("BEGIN")
+        try:
+            yield con
+        finally:
+            con.execute("COMMIT")
+
+
+# Readers never wait for each other or for the writer. Write transactions
+# of this process queue on write_lock instead of polling SQLite's busy lock.
+# Callbacks registered with after_commit run once the outermost transaction
+# has committed, and are dropped when it rolls back.
+@contextmanager
+def transaction():
+    with connection() as con:
+        if con.in_transaction:
+            yield con
+            return
+        start = time.perf_counter()
+        with write_lock:
+            behaviour_digital_twin_metrics.observe("hestia_write_lock_wait_seconds", (), time.perf_counter() - start)
+            con.execute("BEGIN IMMEDIATE")
+            connection_local.after_commit = []
+            try:
+                yield con
+                con.execute("COMMIT")
+                callbacks = connection_local.after_commit
+            except BaseException:
+                if con.in_transaction:
+                    con.execute("ROLLBACK")
+                raise
+            finally:
+                connection_local.after_commit = None
+        for callback in callbacks:
+            callback()
+
+
+def after_commit(callback):
+    callbacks = getattr(connection_local, "after_commit", None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
+
+def migration_1(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS actions(timestamp INTEGER, participantId TEXT, actionId TEXT, actionCompleted INTEGER)")
+    cur.execute("CREATE TABLE IF NOT EXISTS replies(timestamp INTEGER, participantId TEXT, questionnaireId TEXT, questionId TEXT, answerId TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS parameters(timestamp INTEGER, key TEXT, value REAL)")
+
+
+def migration_2(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS latest_scores(model TEXT, topicId TEXT, participantId TEXT, questionnaireId TEXT, timestamp INTEGER, scores TEXT, PRIMARY KEY(model, topicId, participantId))")
+    rebuild_latest_scores_with(cur)
+
+
+def migration_3(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS actions_participant_action ON actions(participantId, actionId)")
+    cur.execute("CREATE INDEX IF NOT EXISTS replies_participant_questionnaire_timestamp ON replies(participantId, questionnaireId, timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS parameters_key_timestamp ON parameters(key, timestamp)")
+
+
+def migration_4(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS action_counts(participantId TEXT, actionId TEXT, total INTEGER, completed INTEGER, PRIMARY KEY(participantId, actionId))")
+    rebuild_action_counts_with(cur)
+
+
+def migration_5(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS parameter_sets(version INTEGER PRIMARY KEY AUTOINCREMENT, timestamp INTEGER)")
+    cur.execute("INSERT INTO parameter_sets(timestamp) VALUES (?)", (int(time.time()),))
+
+
+def migration_6(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS calibration_runs(topicId TEXT PRIMARY KEY, timestamp INTEGER, fingerprint TEXT, iterations INTEGER, loss REAL)")
+
+
+def migration_7(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS idempotency_keys(eventId TEXT PRIMARY KEY, timestamp INTEGER)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idempotency_keys_timestamp ON idempotency_keys(timestamp)")
+
+
+def migration_8(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS action_buckets(participantId TEXT, actionId TEXT, day INTEGER, total INTEGER, completed INTEGER, PRIMARY KEY(participantId, actionId, day))")
+    rebuild_action_buckets_with(cur)
+
+
+def migration_9(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS latest_scores_state(id INTEGER PRIMARY KEY CHECK(id=0), fingerprint TEXT)")
+    rebuild_latest_scores_with(cur)
+    set_latest_scores_fingerprint(cur, behaviour_digital_twin_configuration.get_scoring_fingerprint())
+
+
+def migration_10(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS actions_timestamp ON actions(timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS replies_timestamp ON replies(timestamp)")
+
+
+# Migrations are applied in order and recorded in the user_version pragma
+schema_migrations = [migration_1, migration_2, migration_3, migration_4, migration_5, migration_6, migration_7, migration_8, migration_9, migration_10]
+
+# The queries on the request path, with sample arguments, whose plans must
+# use an index rather than a full table scan
+hot_queries = {
+    "get_action_response_rate": ("SELECT total, completed FROM action_counts WHERE participantId=? AND actionId=?", ("", "")),
+    "update_latest_scores": ("SELECT timestamp, questionId, answerId FROM replies WHERE participantId=? AND questionnaireId=? ORDER BY timestamp DESC", ("", "")),
+    "get_latest_replies": ("SELECT scores FROM latest_scores WHERE model=? AND topicId=? AND participantId=?", ("", "", "")),
+    "get_latest_replies_for": ("SELECT participantId, scores FROM latest_scores WHERE model=? AND topicId=? AND participantId IN (?,?)", ("", "", "", "")),
+    "iterate_latest_scores": ("SELECT t.participantId, t.scores, s.scores FROM latest_scores t "
+                              "JOIN latest_scores s ON s.model='SDT' AND s.topicId=t.topicId AND s.participantId=t.participantId "
+                              "WHERE t.model='TPB' AND t.topicId=? ORDER BY t.participantId", ("",)),
+    "get_action_response_rates": ("SELECT participantId, actionId, total, completed FROM action_counts WHERE participantId IN (?,?) AND actionId IN (?,?)", ("", "", "", "")),
+    "get_action_response_rate_buckets": ("SELECT day, total, completed FROM action_buckets WHERE participantId=? AND actionId=? AND day>=?", ("", "", 0)),
+    "get_summary_actions": ("SELECT MAX(timestamp) FROM actions", ()),
+    "get_summary_replies": ("SELECT MAX(timestamp) FROM replies", ()),
+    "get_summary_idempotency_keys": ("SELECT MIN(rowid) FROM idempotency_keys", ()),
+    "get_action_response_rates_buckets": ("SELECT participantId, actionId, day, total, completed FROM action_buckets WHERE participantId IN (?,?) AND actionId IN (?,?) AND day>=?", ("", "", "", "", 0)),
+}
+
+
+def get_query_plans():
+    plans = {}
+    with connection() as con:
+        for name in hot_queries:
+            sql, args = hot_queries[name]
+            plans[name] = [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql, args)]
+    return plans
+
+
+def check_query_plans():
+    unindexed = []
+    plans = get_query_plans()
+    for name in plans:
+        for detail in plans[name]:
+            if detail.startswith("SCAN") or ("TEMP B-TREE" in detail):
+                unindexed.append(name)
+                break
+    return unindexed
+
+
+def initialise_database():
+    global schema_pid
+    with schema_lock:
+        if schema_pid == os.getpid():
+            return
+        con = open_connection()
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(schema_migrations):
+                con.execute("BEGIN IMMEDIATE")
+                try:
+                    version = con.execute("PRAGMA user_version").fetchone()[0]
+                    for migration in schema_migrations[version:]:
+                        migration(con.cursor())
+                    con.execute("PRAGMA user_version=%d" % len(schema_migrations))
+                except BaseException:
+                    con.execute("ROLLBACK")
+                    raise
+                con.execute("COMMIT")
+                con.execute("ANALYZE")
+        finally:
+            con.close()
+        schema_pid = os.getpid()
+    return
+
+
+append_only_tables = ["actions", "replies"]
+# Rows are only ever added to these tables, or deleted all at once by a
+# rebuild, so their largest rowid is their row count
+growing_tables = append_only_tables + ["latest_scores", "action_counts", "action_buckets"]
+# Rows are only deleted from these tables oldest first, so their rowid range
+# is their row count
+pruned_tables = ["idempotency_keys"]
+dump_page_size = 1000
+dump_max_page_size = 100000
+
+
+def get_tables(con):
+    return [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+# Cheap overview for the admin route: row counts, latest timestamps and sizes
+# without reading any rows into memory
+@behaviour_digital_twin_metrics.timed
+def get_summary():
+    result = {"Tables": {}}
+    with snapshot() as con:
+        for table in get_tables(con):
+            columns = [row[1] for row in con.execute("PRAGMA table_info(" + table + ")")]
+            # Only the small configuration tables are counted by a scan
+            if table in growing_tables:
+                sql = "SELECT MAX(rowid) FROM " + table
+            elif table in pruned_tables:
+                sql = "SELECT (SELECT MAX(rowid) FROM " + table + ") - (SELECT MIN(rowid) FROM " + table + ") + 1"
+            else:
+                sql = "SELECT COUNT(*) FROM " + table
+            result["Tables"][table] = {"Rows": con.execute(sql).fetchone()[0] or 0}
+            if "timestamp" in columns:
+                result["Tables"][table]["LatestTimestamp"] = con.execute("SELECT MAX(timestamp) FROM " + table).fetchone()[0]
+        page_count = con.execute("PRAGMA page_count").fetchone()[0]
+        page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    result["DatabaseSize"] = page_count * page_size
     try:
-        f = open("./data/log.txt", "r")
-        result["Log"] = f.read()
-        f.close()
-    except:
-        None
+        result["WALSize"] = os.path.getsize(database_file + "-wal")
+    except OSError:
+        result["WALSize"] = 0
+    result.update(behaviour_digital_twin_logging.get_log_status())
+    result["QueryPlans"] = get_query_plans()
     return result
 
 
-def log_entry(s):
-    timestamp = datetime.now()
-    f = open("./data/log.txt", "a")
-    f.write("[" + str(timestamp) + "] " + s)
-    f.close()
-    return
+# Yields one page of a table as dicts in rowid order, starting after the
+# given rowid and optionally restricted to a timestamp range
+@behaviour_digital_twin_metrics.timed
+def iterate_table(table, after=0, limit=dump_page_size, start=None, end=None):
+    limit = max(1, min(int(limit), dump_max_page_size))
+    with snapshot() as con:
+        if table not in get_tables(con):
+            raise ValueError("Unknown table " + str(table))
+        columns = [row[1] for row in con.execute("PRAGMA table_info(" + table + ")")]
+        sql = "SELECT rowid, " + ", ".join(columns) + " FROM " + table + " WHERE rowid>?"
+        args = [int(after)]
+        if (start is not None) or (end is not None):
+            if "timestamp" not in columns:
+                raise ValueError("Table " + table + " has no timestamp")
+            if start is not None:
+                sql += " AND timestamp>=?"
+                args.append(int(start))
+            if end is not None:
+                sql += " AND timestamp<?"
+                args.append(int(end))
+        sql += " ORDER BY rowid LIMIT ?"
+        args.append(limit)
+        names = ["rowid"] + columns
+        for row in con.execute(sql, args):
+            yield dict(zip(names, row))
+
+
+# Events may carry a client generated eventId. Ids already recorded in
+# idempotency_keys are skipped, so clients can safely replay a batch after a
+# failure. Returns for each eventId whether the event is new, and records
+# the new ids in the same transaction. Ids are kept for
+# IdempotencyKeyRetentionDays.
+idempotency_keys_pruned = 0.0
+idempotency_keys_prune_interval = 3600.0
 
 
-def report_action(participantId, actionId, actionCompleted):
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    res = cur.execute("SELECT name FROM sqlite_master WHERE name=\"actions\"")
-    if res.fetchone() is None:
-        cur.execute("CREATE TABLE actions(timestamp INTEGER, participantId TEXT, actionId TEXT, actionCompleted INTEGER)")
+@behaviour_digital_twin_metrics.timed
+def claim_event_ids(con, eventIds):
+    global idempotency_keys_pruned
+    known = set()
+    for chunk in chunks([eventId for eventId in eventIds if eventId is not None]):
+        sql = "SELECT eventId FROM idempotency_keys WHERE eventId IN (" + ",".join("?"*len(chunk)) + ")"
+        known.update(row[0] for row in con.execute(sql, chunk))
+    new = []
+    claimed = []
+    for eventId in eventIds:
+        if eventId is None:
+            new.append(True)
+        elif eventId in known:
+            new.append(False)
+        else:
+            known.add(eventId)
+            claimed.append(eventId)
+            new.append(True)
+    now = int(time.time())
+    con.executemany("INSERT INTO idempotency_keys(eventId, timestamp) VALUES (?,?)", [(eventId, now) for eventId in claimed])
+    if time.monotonic() - idempotency_keys_pruned > idempotency_keys_prune_interval:
+        idempotency_keys_pruned = time.monotonic()
+        retention = behaviour_digital_twin_configuration.get_parameter("IdempotencyKeyRetentionDays")
+        con.execute("DELETE FROM idempotency_keys WHERE timestamp<?", (now - int(retention*24*3600),))
+    return new
+
+
+def report_action(participantId, actionId, actionCompleted, eventId=None):
     timestamp = int(time.time())
-    cur.execute("INSERT INTO actions(timestamp, participantId, actionId, actionCompleted) VALUES (%d,\"%s\",\"%s\",%d)" % (timestamp, participantId, actionId, int(actionCompleted)))
-    con.commit()
+    report_actions([(timestamp, participantId, actionId, actionCompleted, eventId)])
     return
 
 
+# Writes a batch of (timestamp, participantId, actionId, actionCompleted,
+# eventId) events in a single transaction, together with the matching
+# increments of the per participant and action counters and of their daily
+# buckets. Returns the number of events written, replayed events are
+# skipped.
+@behaviour_digital_twin_metrics.timed
+def report_actions(actions):
+    with transaction() as con:
+        new = claim_event_ids(con, [action[4] for action in actions])
+        actions = [action for action, is_new in zip(actions, new) if is_new]
+        counts = {}
+        buckets = {}
+        for timestamp, participantId, actionId, actionCompleted, eventId in actions:
+            for aggregate, key in ((counts, (participantId, actionId)), (buckets, (participantId, actionId, int(timestamp) // seconds_per_day))):
+                if key not in aggregate:
+                    aggregate[key] = [0, 0]
+                aggregate[key][0] += 1
+                if actionCompleted:
+                    aggregate[key][1] += 1
+        con.executemany("INSERT INTO actions(timestamp, participantId, actionId, actionCompleted) VALUES (?,?,?,?)",
+                        [(timestamp, participantId, actionId, int(actionCompleted))
+                         for timestamp, participantId, actionId, actionCompleted, eventId in actions])
+        con.executemany("INSERT INTO action_counts(participantId, actionId, total, completed) VALUES (?,?,?,?) "
+                        "ON CONFLICT(participantId, actionId) DO UPDATE SET total=total+excluded.total, completed=completed+excluded.completed",
+                        [(key[0], key[1], counts[key][0], counts[key][1]) for key in counts])
+        con.executemany("INSERT INTO action_buckets(participantId, actionId, day, total, completed) VALUES (?,?,?,?,?) "
+                        "ON CONFLICT(participantId, actionId, day) DO UPDATE SET total=total+excluded.total, completed=completed+excluded.completed",
+                        [(key[0], key[1], key[2], buckets[key][0], buckets[key][1]) for key in buckets])
+    return len(actions)
+
+
 def report_reply(participantId, questionnaireId, questionId, answerId):
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    res = cur.execute("SELECT name FROM sqlite_master WHERE name=\"replies\"")
-    if res.fetchone() is None:
-        cur.execute("CREATE TABLE replies(timestamp INTEGER, participantId TEXT, questionnaireId TEXT, questionId TEXT, answerId TEXT)")
-    timestamp = int(time.time())
-    cur.execute("INSERT INTO replies(timestamp, participantId, questionnaireId, questionId, answerId) VALUES (%d,\"%s\",\"%s\",\"%s\",\"%s\")" % (timestamp, participantId, questionnaireId, questionId, answerId))
-    con.commit()
+    report_replies([(participantId, questionnaireId, [(questionId, answerId)], None)])
     return
 
 
+# Writes whole questionnaire submissions, given as (participantId,
+# questionnaireId, [(questionId, answerId), ...], eventId), in a single
+# transaction. Returns the number of submissions written, replayed
+# submissions are skipped.
+@behaviour_digital_twin_metrics.timed
+def report_replies(submissions):
+    ensure_latest_scores()
+    timestamp = int(time.time())
+    with transaction() as con:
+        new = claim_event_ids(con, [submission[3] for submission in submissions])
+        submissions = [submission for submission, is_new in zip(submissions, new) if is_new]
+        con.executemany("INSERT INTO replies(timestamp, participantId, questionnaireId, questionId, answerId) VALUES (?,?,?,?,?)",
+                        [(timestamp, participantId, questionnaireId, questionId, answerId)
+                         for participantId, questionnaireId, replies, eventId in submissions
+                         for questionId, answerId in replies])
+        updated = set()
+        for participantId, questionnaireId, replies, eventId in submissions:
+            if (participantId, questionnaireId) not in updated:
+                updated.add((participantId, questionnaireId))
+                update_latest_scores(participantId, questionnaireId)
+    return len(submissions)
+
+
+# Every write to the parameters table records a new parameter set version.
+# The latest values are held in memory, compiled per topic and action, and
+# replaced as a whole when the version changes. Writes from this process
+# refresh the cache once they commit, writes from other processes are
+# picked up after at most parameter_cache_check_interval seconds.
+parameter_cache = None
+parameter_cache_checked = 0.0
+parameter_cache_check_interval = 5.0
+parameter_cache_lock = threading.Lock()
+tpb_parameter_prefixes = ["wA_", "wSN_", "wPBC_"]
+sdt_parameter_prefixes = ["wInt_", "wId_", "wIntro_", "wExt_"]
+
+
+@behaviour_digital_twin_metrics.timed
 def set_parameters(key_value_pairs, replace=True):
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    res = cur.execute("SELECT name FROM sqlite_master WHERE name=\"parameters\"")
-    if res.fetchone() is None:
-        cur.execute("CREATE TABLE parameters(timestamp INTEGER, key TEXT, value REAL)")
     timestamp = int(time.time())
-    for key in key_value_pairs:
-        if replace:
-            cur.execute("DELETE FROM parameters WHERE key=\"%s\""%key)
-        cur.execute("INSERT INTO parameters(timestamp, key, value) VALUES (%d,\"%s\",%f)" % (timestamp, key, key_value_pairs[key]))
-    con.commit()
+    with transaction() as con:
+        for key in key_value_pairs:
+            if replace:
+                con.execute("DELETE FROM parameters WHERE key=?", (key,))
+            con.execute("INSERT INTO parameters(timestamp, key, value) VALUES (?,?,?)", (timestamp, key, float(key_value_pairs[key])))
+        con.execute("INSERT INTO parameter_sets(timestamp) VALUES (?)", (timestamp,))
+        after_commit(refresh_parameter_cache)
     return
 
 
+@behaviour_digital_twin_metrics.timed
+def load_parameter_cache():
+    values = {}
+    with snapshot() as con:
+        version = con.execute("SELECT MAX(version) FROM parameter_sets").fetchone()[0]
+        for row in con.execute("SELECT key, value FROM parameters ORDER BY timestamp"):
+            values[row[0]] = float(row[1])
+    topics = set()
+    for key in values:
+        for prefix in tpb_parameter_prefixes + sdt_parameter_prefixes:
+            if key.startswith(prefix):
+                topics.add(key[len(prefix):])
+    tpb = {}
+    sdt = {}
+    for topic in topics:
+        tpb_keys = [prefix + topic for prefix in tpb_parameter_prefixes]
+        if all(key in values for key in tpb_keys):
+            tpb[topic] = [values[key] for key in tpb_keys]
+        sdt_keys = [prefix + topic for prefix in sdt_parameter_prefixes]
+        if all(key in values for key in sdt_keys):
+            sdt[topic] = [values[key] for key in sdt_keys]
+    IAG = {key[len("IAG_"):]: values[key] for key in values if key.startswith("IAG_")}
+    return {"Version": version, "Values": values, "TPB": tpb, "SDT": sdt, "IAG": IAG}
+
+
+def refresh_parameter_cache(only_if_changed=False):
+    global parameter_cache, parameter_cache_checked
+    with parameter_cache_lock:
+        if only_if_changed and (parameter_cache is not None):
+            with connection() as con:
+                version = con.execute("SELECT MAX(version) FROM parameter_sets").fetchone()[0]
+            if version == parameter_cache["Version"]:
+                parameter_cache_checked = time.monotonic()
+                return parameter_cache
+        parameter_cache = load_parameter_cache()
+        parameter_cache_checked = time.monotonic()
+        return parameter_cache
+
+
+def get_parameter_cache():
+    cache = parameter_cache
+    if (cache is None) or (time.monotonic() - parameter_cache_checked > parameter_cache_check_interval):
+        cache = refresh_parameter_cache(only_if_changed=True)
+    return cache
+
+
+# The fingerprint, iterations and final loss of the last published
+# calibration of every topic
+@behaviour_digital_twin_metrics.timed
+def set_calibration_runs(runs):
+    timestamp = int(time.time())
+    with transaction() as con:
+        con.executemany("INSERT OR REPLACE INTO calibration_runs(topicId, timestamp, fingerprint, iterations, loss) VALUES (?,?,?,?,?)",
+                        [(topic, timestamp, runs[topic]["Fingerprint"], runs[topic]["Iterations"], runs[topic]["Loss"]) for topic in runs])
+    return
+
+
+@behaviour_digital_twin_metrics.timed
+def get_calibration_runs():
+    runs = {}
+    with connection() as con:
+        for row in con.execute("SELECT topicId, timestamp, fingerprint, iterations, loss FROM calibration_runs"):
+            runs[row[0]] = {"Timestamp": row[1], "Fingerprint": row[2], "Iterations": row[3], "Loss": row[4]}
+    return runs
+
+
 def get_parameters(keys):
-    key_value_pairs = {}
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    for key in keys:
-        res = cur.execute("SELECT timestamp, key, value FROM parameters WHERE (key=\"%s\") ORDER BY timestamp DESC"%(key))
-        first = res.fetchone()
-        if first is not None:
-            value = float(first[2])
-            key_value_pairs[key] = value
-    return key_value_pairs
+    values = get_parameter_cache()["Values"]
+    return {key: values[key] for key in keys if key in values}
 
 
+# Section scores are materialized per (model, topic, participant) so that
+# model evaluations read a single row instead of the reply history. The table
+# is kept up to date by update_latest_scores on every reply submission and can
+# be regenerated from the replies table with rebuild_latest_scores.
+@behaviour_digital_twin_metrics.timed
 def get_latest_replies(model, topicId, participantId):
-    questionnaireIdsForTopic = behaviour_digital_twin_configuration.get_questionnaireIds_for_topic(model, topicId)
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    questionnaireIdsForTopicAndParticipant = set()
-    for questionnaireId in cur.execute("SELECT DISTINCT questionnaireId FROM replies WHERE participantId=\"%s\""%(participantId)):
-        if questionnaireId[0] in questionnaireIdsForTopic:
-            questionnaireIdsForTopicAndParticipant.add(questionnaireId[0])
-    latest_overall_timestamp = 0
-    result = None
-    for questionnaireId in questionnaireIdsForTopicAndParticipant:
+    ensure_latest_scores()
+    with connection() as con:
+        res = con.execute("SELECT scores FROM latest_scores WHERE model=? AND topicId=? AND participantId=?", (model, topicId, participantId))
+        row = res.fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+# Splits a list of ids into chunks small enough for one IN (...) clause
+def chunks(ids):
+    ids = list(dict.fromkeys(ids))
+    return [ids[i:i + query_chunk_size] for i in range(0, len(ids), query_chunk_size)]
+
+
+# Batch version of get_latest_replies, returns {(topicId, participantId): scores}
+@behaviour_digital_twin_metrics.timed
+def get_latest_replies_for(model, topicIds, participantIds):
+    ensure_latest_scores()
+    replies = {}
+    with snapshot() as con:
+        for topicId in dict.fromkeys(topicIds):
+            for chunk in chunks(participantIds):
+                sql = "SELECT participantId, scores FROM latest_scores WHERE model=? AND topicId=? AND participantId IN (" + ",".join("?"*len(chunk)) + ")"
+                for row in con.execute(sql, [model, topicId] + chunk):
+                    replies[(topicId, row[0])] = json.loads(row[1])
+    return replies
+
+
+# Yields (participantId, TPB scores, SDT scores) for every participant with
+# both sets of scores for a topic, in participantId order. The connection is
+# held until the generator is exhausted or closed.
+@behaviour_digital_twin_metrics.timed
+def iterate_latest_scores(topicId):
+    ensure_latest_scores()
+    with snapshot() as con:
+        cur = con.execute("SELECT t.participantId, t.scores, s.scores FROM latest_scores t "
+                          "JOIN latest_scores s ON s.model='SDT' AND s.topicId=t.topicId AND s.participantId=t.participantId "
+                          "WHERE t.model='TPB' AND t.topicId=? ORDER BY t.participantId", (topicId,))
+        for row in cur:
+            yield row[0], json.loads(row[1]), json.loads(row[2])
+
+
+def store_latest_scores(cur, participantId, questionnaireId, timestamp, question_answer_pairs):
+    for model, topicId in behaviour_digital_twin_configuration.get_models_and_topics_for_questionnaireId(questionnaireId):
+        model_set = behaviour_digital_twin_configuration.extract_complete_set(model, questionnaireId, question_answer_pairs)
+        if model_set is not None:
+            cur.execute("INSERT INTO latest_scores(model, topicId, participantId, questionnaireId, timestamp, scores) VALUES (?,?,?,?,?,?) "
+                        "ON CONFLICT(model, topicId, participantId) DO UPDATE SET questionnaireId=excluded.questionnaireId, timestamp=excluded.timestamp, scores=excluded.scores "
+                        "WHERE excluded.timestamp>=latest_scores.timestamp",
+                        (model, topicId, participantId, questionnaireId, timestamp, json.dumps(model_set)))
+
+
+@behaviour_digital_twin_metrics.timed
+def update_latest_scores(participantId, questionnaireId):
+    ensure_latest_scores()
+    with transaction() as con:
+        cur = con.cursor()
         question_answer_pairs = {}
         latest_timestamp = 0
-        for row in cur.execute("SELECT timestamp, questionId, answerId FROM replies WHERE (participantId=\"%s\") AND (questionnaireId=\"%s\") ORDER BY timestamp DESC"%(participantId,questionnaireId)):
+        for row in cur.execute("SELECT timestamp, questionId, answerId FROM replies WHERE participantId=? AND questionnaireId=? ORDER BY timestamp DESC", (participantId, questionnaireId)):
             timestamp = int(row[0])
             questionId = row[1]
             answerId = row[2]
@@ -151,52 +608,249 @@ def get_latest_replies(model, topicId, participantId):
                 if timestamp > latest_timestamp:
                     latest_timestamp = timestamp
                 question_answer_pairs[questionId] = answerId
-        model_set = behaviour_digital_twin_configuration.extract_complete_set(model,questionnaireId,question_answer_pairs)
-        if model_set is not None:
-            if latest_timestamp > latest_overall_timestamp:
-                latest_overall_timestamp = latest_timestamp
-                result = model_set
-    return result
+        store_latest_scores(cur, participantId, questionnaireId, latest_timestamp, question_answer_pairs)
+    return
+
+
+@behaviour_digital_twin_metrics.timed
+def rebuild_latest_scores():
+    fingerprint = behaviour_digital_twin_configuration.get_scoring_fingerprint()
+    with transaction() as con:
+        rebuild_latest_scores_with(con.cursor())
+        set_latest_scores_fingerprint(con, fingerprint)
+    return
+
 
+def set_latest_scores_fingerprint(cur, fingerprint):
+    cur.execute("INSERT INTO latest_scores_state(id, fingerprint) VALUES (0,?) "
+                "ON CONFLICT(id) DO UPDATE SET fingerprint=excluded.fingerprint", (fingerprint,))
 
+
+# latest_scores holds the scores computed with the models, scales and
+# questionnaires of the registry at the time of writing, and the table
+# records the fingerprint of those rules. When the registry has been
+# reloaded with different rules, the first caller that notices rebuilds the
+# table. Readers inside an open transaction leave that to the outermost
+# caller, which checks before the transaction starts.
+latest_scores_fingerprint = None
+
+
+def ensure_latest_scores():
+    global latest_scores_fingerprint
+    fingerprint = behaviour_digital_twin_configuration.get_scoring_fingerprint()
+    if fingerprint == latest_scores_fingerprint:
+        return
+    with connection() as con:
+        if con.in_transaction:
+            return
+        with transaction():
+            row = con.execute("SELECT fingerprint FROM latest_scores_state WHERE id=0").fetchone()
+            if (row is None) or (row[0] != fingerprint):
+                print("Scoring rules changed, rebuilding latest scores")
+                rebuild_latest_scores_with(con.cursor())
+                set_latest_scores_fingerprint(con, fingerprint)
+    latest_scores_fingerprint = fingerprint
+
+
+def rebuild_latest_scores_with(cur):
+    cur.execute("DELETE FROM latest_scores")
+    latest = {}
+    for row in cur.execute("SELECT timestamp, participantId, questionnaireId, questionId, answerId FROM replies ORDER BY timestamp DESC"):
+        timestamp = int(row[0])
+        key = (row[1], row[2])
+        if key not in latest:
+            latest[key] = [timestamp, {}]
+        if not row[3] in latest[key][1]:
+            latest[key][1][row[3]] = row[4]
+    for participantId, questionnaireId in latest:
+        timestamp, question_answer_pairs = latest[(participantId, questionnaireId)]
+        store_latest_scores(cur, participantId, questionnaireId, timestamp, question_answer_pairs)
+    return
+
+
+@behaviour_digital_twin_metrics.timed
 def delete_all_data():
-    os.remove("./data/Hestia_BehaviourDigitalTwin_data.db")
+    with transaction() as con:
+        version = con.execute("SELECT MAX(version) FROM parameter_sets").fetchone()[0]
+        tables = [row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type=\"table\" AND name NOT LIKE \"sqlite_%\"")]
+        for table in tables:
+            con.execute("DROP TABLE \"%s\"" % table)
+        for migration in schema_migrations:
+            migration(con.cursor())
+        # Keep parameter set versions increasing so that other processes
+        # notice that their cached parameters are gone
+        con.execute("INSERT INTO parameter_sets(version, timestamp) VALUES (MAX(?, (SELECT MAX(version) FROM parameter_sets)) + 1, ?)", (version or 0, int(time.time())))
+        after_commit(refresh_parameter_cache)
+    return
+
+
+@behaviour_digital_twin_metrics.timed
+def rebuild_action_counts():
+    with transaction() as con:
+        rebuild_action_counts_with(con.cursor())
+    return
+
+
+def rebuild_action_counts_with(cur):
+    cur.execute("DELETE FROM action_counts")
+    cur.execute("INSERT INTO action_counts(participantId, actionId, total, completed) "
+                "SELECT participantId, actionId, COUNT(*), SUM(actionCompleted<>0) FROM actions GROUP BY participantId, actionId")
+    return
+
+
+@behaviour_digital_twin_metrics.timed
+def rebuild_action_buckets():
+    with transaction() as con:
+        rebuild_action_buckets_with(con.cursor())
     return
 
 
-def get_all_action_response_rates():
+def rebuild_action_buckets_with(cur):
+    cur.execute("DELETE FROM action_buckets")
+    cur.execute("INSERT INTO action_buckets(participantId, actionId, day, total, completed) "
+                "SELECT participantId, actionId, CAST(timestamp AS INTEGER)/?, COUNT(*), SUM(actionCompleted<>0) FROM actions "
+                "GROUP BY participantId, actionId, CAST(timestamp AS INTEGER)/?", (seconds_per_day, seconds_per_day))
+    return
+
+
+# Response rates cover the whole history by default. With a window only the
+# daily buckets of the last window_days days, today included, are counted,
+# and with a half-life every bucket is weighted by 0.5**(age/half_life_days),
+# so the counts become fractional. Both default to the ResponseRateWindowDays
+# and ResponseRateHalfLifeDays parameters, 0 meaning unlimited and no decay.
+def get_response_rate_window(window_days=None, half_life_days=None):
+    if window_days is None:
+        window_days = behaviour_digital_twin_configuration.get_parameter("ResponseRateWindowDays")
+    if half_life_days is None:
+        half_life_days = behaviour_digital_twin_configuration.get_parameter("ResponseRateHalfLifeDays")
+    today = int(time.time()) // seconds_per_day
+    if window_days > 0:
+        first_day = today - int(window_days) + 1
+    else:
+        first_day = 0
+    return today, first_day, half_life_days
+
+
+def bucket_weight(today, day, half_life_days):
+    if half_life_days > 0:
+        return 0.5 ** (max(today - day, 0) / half_life_days)
+    return 1
+
+
+# Returns the counts of all actions, or of the given actions only
+@behaviour_digital_twin_metrics.timed
+def get_all_action_response_rates(window_days=None, half_life_days=None, actionIds=None):
     N = {}
     n = {}
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    for row in cur.execute("SELECT participantId, actionId, actionCompleted FROM actions"):
-        participantId = row[0]
-        actionId = row[1]
-        completed = bool(row[2])
-        if actionId not in N:
-            N[actionId] = {}
-            n[actionId] = {}
-        if participantId not in N[actionId]:
-            N[actionId][participantId] = 0
-            n[actionId][participantId] = 0
-        N[actionId][participantId] += 1
-        if completed:
-            n[actionId][participantId] += 1
+    today, first_day, half_life_days = get_response_rate_window(window_days, half_life_days)
+    weighted = (first_day > 0) or (half_life_days > 0)
+    if actionIds is None:
+        selections = [("", [])]
+    else:
+        selections = [("actionId IN (" + ",".join("?"*len(chunk)) + ")", chunk) for chunk in chunks(actionIds)]
+    with connection() as con:
+        for condition, args in selections:
+            if weighted:
+                rows = con.execute("SELECT participantId, actionId, total, completed, day FROM action_buckets WHERE day>=?" +
+                                   (" AND " + condition if condition else ""), [first_day] + args)
+            else:
+                rows = con.execute("SELECT participantId, actionId, total, completed FROM action_counts" +
+                                   (" WHERE " + condition if condition else ""), args)
+            for row in rows:
+                participantId = row[0]
+                actionId = row[1]
+                if actionId not in N:
+                    N[actionId] = {}
+                    n[actionId] = {}
+                if weighted:
+                    weight = bucket_weight(today, row[4], half_life_days)
+                    N[actionId][participantId] = N[actionId].get(participantId, 0) + weight * row[2]
+                    n[actionId][participantId] = n[actionId].get(participantId, 0) + weight * row[3]
+                else:
+                    N[actionId][participantId] = row[2]
+                    n[actionId][participantId] = row[3]
     return N,n
 
 
-def get_action_response_rate(participantId, actionId):
-    con = sqlite3.connect("./data/Hestia_BehaviourDigitalTwin_data.db")
-    cur = con.cursor()
-    n = 0
-    N = 0
-    for row in cur.execute("SELECT actionCompleted FROM actions WHERE (participantId=\"%s\") AND (actionId=\"%s\")"%(participantId,actionId)):
-        completed = bool(row[0])
-        N += 1
-        if completed:
-            n+=1
-    if (N>0):
-        return float(n)/float(N)
+# The last row of an append-only event table, with its rowid first, marks
+# how far the table's history goes; None for an empty table
+def get_history_marker(table):
+    if table not in append_only_tables:
+        raise ValueError("Not an event table " + str(table))
+    with connection() as con:
+        row = con.execute("SELECT rowid, * FROM " + table + " ORDER BY rowid DESC LIMIT 1").fetchone()
+    return None if row is None else list(row)
+
+
+# Whether the table still holds the row of an earlier marker, i.e. its
+# history has only been appended to since
+def history_continues(table, marker):
+    if table not in append_only_tables:
+        raise ValueError("Not an event table " + str(table))
+    if marker is None:
+        return True
+    with connection() as con:
+        row = con.execute("SELECT rowid, * FROM " + table + " WHERE rowid=?", (marker[0],)).fetchone()
+    return (row is not None) and (list(row) == marker)
+
+
+# The distinct values of a column among the rows appended after a marker
+def get_values_since(table, column, marker):
+    if table not in append_only_tables:
+        raise ValueError("Not an event table " + str(table))
+    after = 0 if marker is None else marker[0]
+    with connection() as con:
+        return [row[0] for row in con.execute("SELECT DISTINCT " + column + " FROM " + table + " WHERE rowid>?", (after,))]
+
+
+@behaviour_digital_twin_metrics.timed
+def get_action_response_rate(participantId, actionId, window_days=None, half_life_days=None):
+    today, first_day, half_life_days = get_response_rate_window(window_days, half_life_days)
+    with connection() as con:
+        if (first_day == 0) and (half_life_days <= 0):
+            row = con.execute("SELECT total, completed FROM action_counts WHERE participantId=? AND actionId=?", (participantId, actionId)).fetchone()
+        else:
+            row = [0, 0]
+            for day, total, completed in con.execute("SELECT day, total, completed FROM action_buckets WHERE participantId=? AND actionId=? AND day>=?",
+                                                     (participantId, actionId, first_day)):
+                weight = bucket_weight(today, day, half_life_days)
+                row[0] += weight * total
+                row[1] += weight * completed
+    if (row is not None) and (row[0]>0):
+        return float(row[1])/float(row[0])
     else:
         return None
 
+
+# Batch version of get_action_response_rate, returns {(participantId, actionId): rate}
+@behaviour_digital_twin_metrics.timed
+def get_action_response_rates(participantIds, actionIds, window_days=None, half_life_days=None):
+    counts = {}
+    actionIds = list(dict.fromkeys(actionIds))
+    today, first_day, half_life_days = get_response_rate_window(window_days, half_life_days)
+    with snapshot() as con:
+        for action_chunk in chunks(actionIds):
+            for chunk in chunks(participantIds):
+                if (first_day == 0) and (half_life_days <= 0):
+                    sql = ("SELECT participantId, actionId, total, completed, NULL FROM action_counts WHERE participantId IN (" + ",".join("?"*len(chunk)) + ") "
+                           "AND actionId IN (" + ",".join("?"*len(action_chunk)) + ")")
+                    args = chunk + action_chunk
+                else:
+                    sql = ("SELECT participantId, actionId, total, completed, day FROM action_buckets WHERE participantId IN (" + ",".join("?"*len(chunk)) + ") "
+                           "AND actionId IN (" + ",".join("?"*len(action_chunk)) + ") AND day>=?")
+                    args = chunk + action_chunk + [first_day]
+                for row in con.execute(sql, args):
+                    key = (row[0], row[1])
+                    if key not in counts:
+                        counts[key] = [0, 0]
+                    if row[4] is None:
+                        weight = 1
+                    else:
+                        weight = bucket_weight(today, row[4], half_life_days)
+                    counts[key][0] += weight * row[2]
+                    counts[key][1] += weight * row[3]
+    rates = {}
+    for key in counts:
+        if counts[key][0] > 0:
+            rates[key] = float(counts[key][1])/float(counts[key][0])
+    return rates
@@ -0,0 +1,93 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import csv
+import io
+import json
+import sys
+
+import behaviour_digital_twin_configuration
+import behaviour_digital_twin_models
+
+
+export_fields = ["ParticipantId", "ActionId", "PredictedBehaviour", "BehaviouralIntention", "RelativeAutonomyIndex"]
+export_formats = ["NDJSON", "CSV"]
+
+
+def get_export_actions(actionId=None, topic=None):
+    if actionId is not None:
+        return [actionId]
+    if topic is not None:
+        return behaviour_digital_twin_configuration.get_actions_for_topic(topic)
+    raise ValueError("ActionId or Topic required")
+
+
+# Turns the rows of populationScores into lines of text one at a time
+def format_rows(rows, format):
+    if format == "NDJSON":
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    elif format == "CSV":
+        line = io.StringIO()
+        writer = csv.DictWriter(line, fieldnames=export_fields, lineterminator="\n")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+            yield line.getvalue()
+            line.seek(0)
+            line.truncate()
+        yield line.getvalue()
+    else:
+        raise ValueError("Unknown format " + str(format))
+
+
+def export(actionIds, format):
+    return format_rows(behaviour_digital_twin_models.populationScores(actionIds), format)
+
+
+# Offline export, run from the server directory:
+#   python behaviour_digital_twin_export.py --action Laundry --format CSV --output scores.csv
+def main():
+    parser = argparse.ArgumentParser(description="Export the predicted behaviour of all participants")
+    parser.add_argument("--action", help="action to score")
+    parser.add_argument("--topic", help="score all actions of a topic")
+    parser.add_argument("--format", choices=export_formats, default="NDJSON")
+    parser.add_argument("--output", help="output file, standard output if omitted")
+    args = parser.parse_args()
+    if (args.action is None) and (args.topic is None):
+        parser.error("one of --action or --topic is required")
+
+    actionIds = get_export_actions(args.action, args.topic)
+    if args.output is None:
+        out = sys.stdout
+    else:
+        out = open(args.output, "w", newline="")
+    try:
+        for line in export(actionIds, args.format):
+            out.write(line)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
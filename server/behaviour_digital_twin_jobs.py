@@ -0,0 +1,144 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import time
+import uuid
+from threading import Thread, Lock, Event
+
+import behaviour_digital_twin_calibration
+import behaviour_digital_twin_metrics
+
+# Calibrations run as background jobs. Only one job runs at a time; the
+# most recent jobs are kept so that their outcome can still be queried.
+jobs = {}
+jobs_lock = Lock()
+calibration_lock = Lock()
+retained_jobs = 20
+
+
+def start_calibration():
+    if not calibration_lock.acquire(blocking=False):
+        return None
+    job = {"JobId": str(uuid.uuid4()),
+           "Status": "Running",
+           "Started": time.time(),
+           "Finished": None,
+           "Topics": {},
+           "Result": None,
+           "Error": None,
+           "Cancel": Event()}
+    with jobs_lock:
+        jobs[job["JobId"]] = job
+        finished = [jobId for jobId in jobs if jobs[jobId]["Finished"] is not None]
+        for jobId in finished[:max(0, len(jobs) - retained_jobs)]:
+            del jobs[jobId]
+    try:
+        Thread(target=run_calibration, args=(job,), daemon=True).start()
+    except BaseException:
+        calibration_lock.release()
+        raise
+    return job["JobId"]
+
+
+def run_calibration(job):
+    def progress(topic, iteration, iterations, loss):
+        with jobs_lock:
+            job["Topics"][topic] = {"Iteration": iteration, "Iterations": iterations, "Loss": loss}
+        if job["Cancel"].is_set():
+            raise behaviour_digital_twin_calibration.CalibrationCancelled()
+
+    result = None
+    error_message = None
+    try:
+        result = behaviour_digital_twin_calibration.calibrate(progress=progress)
+        status = "Finished"
+    except behaviour_digital_twin_calibration.CalibrationCancelled:
+        status = "Cancelled"
+    except BaseException as error:
+        status = "Failed"
+        error_message = str(error)
+    with jobs_lock:
+        job["Result"] = result
+        job["Status"] = status
+        job["Error"] = error_message
+        job["Finished"] = time.time()
+    calibration_lock.release()
+    record_metrics(job)
+    return
+
+
+def record_metrics(job):
+    behaviour_digital_twin_metrics.increment("hestia_calibration_runs_total", (job["Status"],))
+    if job["Result"] is None:
+        return
+    behaviour_digital_twin_metrics.set_gauge("hestia_calibration_duration_seconds", (), job["Finished"] - job["Started"])
+    for topic in job["Result"]:
+        fit = job["Result"][topic]
+        if "Seconds" in fit:
+            behaviour_digital_twin_metrics.set_gauge("hestia_calibration_topic_duration_seconds", (topic,), fit["Seconds"])
+        if fit["Loss"] is not None:
+            behaviour_digital_twin_metrics.set_gauge("hestia_calibration_topic_loss", (topic,), fit["Loss"])
+        behaviour_digital_twin_metrics.set_gauge("hestia_calibration_topic_iterations", (topic,), fit["Iterations"])
+
+
+def cancel_calibration(jobId):
+    with jobs_lock:
+        if jobId not in jobs:
+            return False
+        jobs[jobId]["Cancel"].set()
+    return True
+
+
+def get_calibration_status(jobId=None):
+    with jobs_lock:
+        if jobId is None:
+            if not jobs:
+                return None
+            jobId = max(jobs, key=lambda key: jobs[key]["Started"])
+        if jobId not in jobs:
+            return None
+        job = jobs[jobId]
+        status = {"JobId": job["JobId"],
+                  "Status": job["Status"],
+                  "Topics": {topic: dict(job["Topics"][topic]) for topic in job["Topics"]}}
+        if job["Error"] is not None:
+            status["Error"] = job["Error"]
+        if job["Result"] is not None:
+            status["Result"] = job["Result"]
+        finished = job["Finished"]
+        started = job["Started"]
+
+    end = time.time() if finished is None else finished
+    status["Elapsed"] = end - started
+    done = 0
+    total = 0
+    loss = None
+    for topic in status["Topics"]:
+        done += status["Topics"][topic]["Iteration"]
+        total += status["Topics"][topic]["Iterations"]
+        if status["Topics"][topic]["Loss"] is not None:
+            loss = status["Topics"][topic]["Loss"]
+    status["Loss"] = loss
+    if finished is None:
+        if (total > 0) and (done > 0):
+            status["ETA"] = status["Elapsed"] * (total - done) / done
+        else:
+            status["ETA"] = None
+    return status
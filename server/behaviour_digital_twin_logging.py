@@ -0,0 +1,260 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime
+
+import behaviour_digital_twin_configuration
+
+# Request threads only put records on a bounded queue. A single listener
+# thread formats them as JSON lines and writes them to a rotating log file,
+# flushing once the queue is drained or after a full batch. When the queue
+# is full records are dropped and counted rather than blocking the request.
+logger = logging.getLogger("hestia")
+log_file = behaviour_digital_twin_configuration.get_parameter("LogFile")
+log_queue = None
+listener = None
+dropped = 0
+payload_sampler = random.Random()
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"Time": datetime.fromtimestamp(record.created).isoformat(),
+                 "Level": record.levelname,
+                 "Message": record.getMessage()}
+        endpoint = getattr(record, "endpoint", None)
+        if endpoint is not None:
+            entry["Endpoint"] = endpoint
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            entry["Payload"] = payload
+        return json.dumps(entry)
+
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        payload = getattr(record, "payload", None)
+        if payload is None:
+            return record.getMessage()
+        return record.getMessage() + ":" + payload
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue, batch_size, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+        self.pending = 0
+
+    def dequeue(self, block):
+        if block and (self.pending > 0) and self.queue.empty():
+            self.flush()
+        return self.queue.get(block)
+
+    def handle(self, record):
+        super().handle(record)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush_batch()
+        self.pending = 0
+
+    # Waits for room on a full queue, which the listener keeps draining,
+    # instead of failing to stop
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# Writes are flushed by the listener once per batch instead of once per
+# record. The size based handler keeps count of the bytes written, buffered
+# ones included, because asking the file for its size would flush it.
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        try:
+            self.size = os.path.getsize(self.baseFilename)
+        except OSError:
+            self.size = 0
+
+    def emit(self, record):
+        try:
+            message = self.format(record) + self.terminator
+            length = len(message.encode(self.encoding or "utf-8"))
+            if (self.maxBytes > 0) and (self.size > 0) and (self.size + length >= self.maxBytes):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(message)
+            self.size += length
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.size = 0
+
+    def flush(self):
+        return
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    def flush(self):
+        return
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchedStreamHandler(logging.StreamHandler):
+    def flush(self):
+        return
+
+    def flush_batch(self):
+        super().flush()
+
+
+def get_file_handler():
+    rotation = behaviour_digital_twin_configuration.get_parameter("LogRotation")
+    if rotation == "Size":
+        return BatchedRotatingFileHandler(log_file, encoding="utf-8",
+                                          maxBytes=behaviour_digital_twin_configuration.get_parameter("LogMaxBytes"),
+                                          backupCount=behaviour_digital_twin_configuration.get_parameter("LogBackupCount"))
+    elif rotation == "Time":
+        return BatchedTimedRotatingFileHandler(log_file, encoding="utf-8",
+                                               when=behaviour_digital_twin_configuration.get_parameter("LogRotationWhen"),
+                                               backupCount=behaviour_digital_twin_configuration.get_parameter("LogBackupCount"))
+    raise ValueError("Unknown log rotation " + str(rotation))
+
+
+def start():
+    global log_queue, listener
+    if listener is not None:
+        return
+    logger.setLevel(behaviour_digital_twin_configuration.get_parameter("LogLevel"))
+    endpoint_levels = behaviour_digital_twin_configuration.get_parameter("LogEndpointLevels")
+    for endpoint in endpoint_levels:
+        get_logger(endpoint).setLevel(endpoint_levels[endpoint])
+
+    file_handler = get_file_handler()
+    file_handler.setFormatter(JSONFormatter())
+    console_handler = BatchedStreamHandler(sys.stdout)
+    console_handler.setFormatter(ConsoleFormatter())
+
+    log_queue = queue.Queue(behaviour_digital_twin_configuration.get_parameter("LogQueueSize"))
+    listener = BatchingQueueListener(log_queue, behaviour_digital_twin_configuration.get_parameter("LogBatchSize"),
+                                     file_handler, console_handler)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    logger.propagate = False
+    listener.start()
+    atexit.register(stop)
+    return
+
+
+def stop():
+    global listener
+    if listener is None:
+        return
+    listener.stop()
+    listener.flush()
+    for handler in listener.handlers:
+        handler.close()
+    listener = None
+    return
+
+
+# Endpoints log through child loggers, so their levels can be set separately
+# in LogEndpointLevels, e.g. {"/Action/": "WARNING"}
+def get_logger(endpoint=None):
+    if endpoint is None:
+        return logger
+    return logger.getChild(endpoint.strip("/").replace("/", "_") or "index")
+
+
+def log(level, message, endpoint=None):
+    get_logger(endpoint).log(level, message, extra={"endpoint": endpoint})
+
+
+# Request and response payloads are only serialised for a sample of the
+# requests and are truncated to LogPayloadMaxLength characters
+def log_payload(label, data, endpoint=None):
+    log_endpoint = get_logger(endpoint)
+    if not log_endpoint.isEnabledFor(logging.INFO):
+        return
+    if payload_sampler.random() >= behaviour_digital_twin_configuration.get_parameter("LogPayloadSampleRate"):
+        return
+    payload = str(data)
+    max_length = behaviour_digital_twin_configuration.get_parameter("LogPayloadMaxLength")
+    if len(payload) > max_length:
+        payload = payload[:max_length] + "..."
+    log_endpoint.info(label, extra={"endpoint": endpoint, "payload": payload})
+
+
+def get_log_status():
+    size = 0
+    try:
+        size = os.path.getsize(log_file)
+    except OSError:
+        None
+    return {"LogSize": size, "LogDropped": dropped}
+
+
+# Yields up to limit lines of the current log file starting at a byte
+# offset, followed by the offset of the next line
+def iterate_log(after=0, limit=1000):
+    try:
+        f = open(log_file, "rb")
+    except OSError:
+        yield int(after)
+        return
+    try:
+        f.seek(int(after))
+        for i in range(limit):
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode("utf-8", errors="replace").rstrip("\r\n")
+        yield f.tell()
+    finally:
+        f.close()
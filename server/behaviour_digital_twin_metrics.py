@@ -0,0 +1,136 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import bisect
+import functools
+import inspect
+import time
+from threading import Lock
+
+# Counters, gauges and histograms kept in memory and rendered in the
+# Prometheus text format by the /metrics route. Every update is a dict
+# lookup and a few additions under one lock, cheap enough to leave on.
+# Metrics are per process.
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+metrics = {
+    "hestia_http_requests_total": ("counter", "Requests handled per route, method and status", ["route", "method", "status"]),
+    "hestia_http_request_errors_total": ("counter", "Requests per route that failed with an exception or a 5xx status", ["route", "method"]),
+    "hestia_http_request_duration_seconds": ("histogram", "Time until the response is returned, per route", ["route", "method"]),
+    "hestia_write_lock_wait_seconds": ("histogram", "Time write transactions waited for the database write lock", []),
+    "hestia_db_calls_total": ("counter", "Calls per database function", ["function"]),
+    "hestia_db_call_duration_seconds": ("histogram", "Time spent per database function", ["function"]),
+    "hestia_action_buffer_write_failures_total": ("counter", "Failed attempts to write a batch of buffered actions", []),
+    "hestia_action_buffer_dropped_total": ("counter", "Buffered actions dropped because they could not be written before stopping", []),
+    "hestia_calibration_runs_total": ("counter", "Calibration jobs per final status", ["status"]),
+    "hestia_calibration_duration_seconds": ("gauge", "Duration of the last finished calibration", []),
+    "hestia_calibration_topic_duration_seconds": ("gauge", "Fitting time of each topic in the last calibration", ["topic"]),
+    "hestia_calibration_topic_loss": ("gauge", "Final loss of each topic in the last calibration", ["topic"]),
+    "hestia_calibration_topic_iterations": ("gauge", "Iterations of each topic in the last calibration", ["topic"]),
+}
+values = {name: {} for name in metrics}
+metrics_lock = Lock()
+
+
+def increment(name, labels=(), amount=1):
+    with metrics_lock:
+        series = values[name]
+        series[labels] = series.get(labels, 0) + amount
+
+
+def set_gauge(name, labels, value):
+    with metrics_lock:
+        values[name][labels] = value
+
+
+# Histograms hold a count per bucket, the sum and the total count
+def observe(name, labels, value):
+    index = bisect.bisect_left(latency_buckets, value)
+    with metrics_lock:
+        series = values[name]
+        if labels not in series:
+            series[labels] = [[0]*len(latency_buckets), 0.0, 0]
+        histogram = series[labels]
+        if index < len(latency_buckets):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+# Records calls and durations of a database function. Generators are timed
+# from the first row until they are exhausted or closed.
+def timed(function):
+    labels = (function.__name__,)
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                yield from function(*args, **kwargs)
+            finally:
+                increment("hestia_db_calls_total", labels)
+                observe("hestia_db_call_duration_seconds", labels, time.perf_counter() - start)
+        return generator
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            increment("hestia_db_calls_total", labels)
+            observe("hestia_db_call_duration_seconds", labels, time.perf_counter() - start)
+    return wrapper
+
+
+def format_labels(names, labels, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, labels)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def render():
+    with metrics_lock:
+        snapshot = {name: {labels: (list(value[0]), value[1], value[2]) if isinstance(value, list) else value
+                           for labels, value in values[name].items()}
+                    for name in values}
+    lines = []
+    for name in metrics:
+        kind, description, label_names = metrics[name]
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels in sorted(snapshot[name]):
+            value = snapshot[name][labels]
+            if kind == "histogram":
+                buckets, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(latency_buckets, buckets):
+                    cumulative += bucket
+                    lines.append("%s_bucket%s %d" % (name, format_labels(label_names, labels, 'le="%g"' % bound), cumulative))
+                lines.append("%s_bucket%s %d" % (name, format_labels(label_names, labels, 'le="+Inf"'), count))
+                lines.append("%s_sum%s %r" % (name, format_labels(label_names, labels), total))
+                lines.append("%s_count%s %d" % (name, format_labels(label_names, labels), count))
+            else:
+                lines.append("%s%s %r" % (name, format_labels(label_names, labels), float(value)))
+    return "\n".join(lines) + "\n"
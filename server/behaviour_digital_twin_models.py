@@ -29,24 +29,21 @@ def TPB(topicId, participantId, tpb_parameters=None):
     PBC = replies["NormativeBeliefs"]
 
     if tpb_parameters is None:
-        try:
-            weights = behaviour_digital_twin_database.get_parameters(["wA_" + topicId, "wSN_" + topicId, "wPBC_" + topicId])
-            wA = weights["wA_"+topicId]
-            wSN = weights["wSN_"+topicId]
-            wPBC = weights["wPBC_"+topicId]
-        except:
-            wA = 1.0
-            wSN = 1.0
-            wPBC = 1.0
-    else:
-        wA = tpb_parameters[0]
-        wSN = tpb_parameters[1]
-        wPBC = tpb_parameters[2]
+        tpb_parameters = behaviour_digital_twin_database.get_parameter_cache()["TPB"].get(topicId, [1.0]*3)
 
-    BI = (wA * A + wSN * SN + wPBC * PBC) / 3.0
+    BI = behaviouralIntention(A, SN, PBC, tpb_parameters)
     return BI, A, SN, PBC
 
 
+def behaviouralIntention(A, SN, PBC, tpb_parameters):
+    wA = tpb_parameters[0]
+    wSN = tpb_parameters[1]
+    wPBC = tpb_parameters[2]
+
+    BI = (wA * A + wSN * SN + wPBC * PBC) / 3.0
+    return BI
+
+
 def SDT(topicId, participantId, sdt_parameters=None):
     replies = behaviour_digital_twin_database.get_latest_replies("SDT", topicId, participantId)
 
@@ -56,49 +53,116 @@ def SDT(topicId, participantId, sdt_parameters=None):
     Rext = replies["External"]
 
     if sdt_parameters is None:
-        try:
-            weights = behaviour_digital_twin_database.get_parameters(["wInt_" + topicId, "wId_" + topicId, "wIntro_" + topicId, "wExt_" + topicId])
-            wInt = weights["wInt_"+topicId]
-            wId = weights["wId_"+topicId]
-            wIntro = weights["wIntro_"+topicId]
-            wExt = weights["wExt_"+topicId]
-        except:
-            wInt = 1.0
-            wId = 1.0
-            wIntro = 1.0
-            wExt = 1.0
-    else:
-        wInt = sdt_parameters[0]
-        wId = sdt_parameters[1]
-        wIntro = sdt_parameters[2]
-        wExt = sdt_parameters[3]
+        sdt_parameters = behaviour_digital_twin_database.get_parameter_cache()["SDT"].get(topicId, [1.0]*4)
 
-    RAI = (2 * wInt * Rint + wId * Rid - wIntro * Rintro - 2 * wExt * Rext) / 6.0
+    RAI = relativeAutonomyIndex(Rint, Rid, Rintro, Rext, sdt_parameters)
     return RAI, Rint, Rid, Rintro, Rext
 
 
+def relativeAutonomyIndex(Rint, Rid, Rintro, Rext, sdt_parameters):
+    wInt = sdt_parameters[0]
+    wId = sdt_parameters[1]
+    wIntro = sdt_parameters[2]
+    wExt = sdt_parameters[3]
+
+    RAI = (2 * wInt * Rint + wId * Rid - wIntro * Rintro - 2 * wExt * Rext) / 6.0
+    return RAI
+
+
 def likelihoodOfBehaviour(actionId, participantId, topic=None, tpb_parameters=None, sdt_parameters=None, IAG=None):
     if topic is None:
         topic = behaviour_digital_twin_configuration.get_topic_for_action(actionId)
 
     if IAG is None:
-        try:
-            IAG = behaviour_digital_twin_database.get_parameters(["IAG_" + actionId])["IAG_" + actionId]
-        except:
-            IAG = 0.0
+        IAG = behaviour_digital_twin_database.get_parameter_cache()["IAG"].get(actionId, 0.0)
 
     BI, A, SN, PBC = TPB(topic, participantId, tpb_parameters)
     RAI, Rint, Rid, Rintro, Rext = SDT(topic, participantId, sdt_parameters)
 
+    P, dP = probabilityOfBehaviour(BI, RAI, IAG)
+
+    return P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext
+
 
+# Evaluates likelihoodOfBehaviour for every pair of actions and participants.
+# Scores and weights are loaded once for all pairs, the result maps
+# (actionId, participantId) to the same tuple, or None if replies are missing.
+def likelihoodsOfBehaviour(actionIds, participantIds):
     lambda_BI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorBI")
     lambda_RAI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorRAI")
+    gamma = behaviour_digital_twin_configuration.get_parameter("ActivationFunctionGamma")
+    cache = behaviour_digital_twin_database.get_parameter_cache()
+
+    topics = {actionId: behaviour_digital_twin_configuration.get_topic_for_action(actionId) for actionId in actionIds}
+    behaviour_digital_twin_database.ensure_latest_scores()
+    with behaviour_digital_twin_database.snapshot():
+        tpb_replies = behaviour_digital_twin_database.get_latest_replies_for("TPB", topics.values(), participantIds)
+        sdt_replies = behaviour_digital_twin_database.get_latest_replies_for("SDT", topics.values(), participantIds)
+
+    likelihoods = {}
+    for actionId in topics:
+        topic = topics[actionId]
+        tpb_parameters = cache["TPB"].get(topic, [1.0]*3)
+        sdt_parameters = cache["SDT"].get(topic, [1.0]*4)
+        IAG = cache["IAG"].get(actionId, 0.0)
+        for participantId in participantIds:
+            tpb = tpb_replies.get((topic, participantId))
+            sdt = sdt_replies.get((topic, participantId))
+            if (tpb is None) or (sdt is None):
+                likelihoods[(actionId, participantId)] = None
+            else:
+                likelihoods[(actionId, participantId)] = likelihoodFromScores(tpb, sdt, tpb_parameters, sdt_parameters, IAG, lambda_BI, lambda_RAI, gamma)
+    return likelihoods
+
+
+def likelihoodFromScores(tpb, sdt, tpb_parameters, sdt_parameters, IAG, lambda_BI, lambda_RAI, gamma):
+    A = tpb["BehaviouralBeliefs"]
+    SN = tpb["ControlBeliefs"]
+    PBC = tpb["NormativeBeliefs"]
+    Rint = sdt["Intrinsic"]
+    Rid = sdt["Identified"]
+    Rintro = sdt["Introjected"]
+    Rext = sdt["External"]
+    BI = behaviouralIntention(A, SN, PBC, tpb_parameters)
+    RAI = relativeAutonomyIndex(Rint, Rid, Rintro, Rext, sdt_parameters)
+    P, dP = probabilityOfBehaviour(BI, RAI, IAG, lambda_BI, lambda_RAI, gamma)
+    return P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext
 
-    beta = lambda_BI*BI + lambda_RAI*RAI - IAG
 
+# Yields the predicted behaviour of every participant with complete replies
+# for each of the given actions. Rows come straight from a database cursor,
+# so the population is never held in memory.
+def populationScores(actionIds):
+    lambda_BI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorBI")
+    lambda_RAI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorRAI")
     gamma = behaviour_digital_twin_configuration.get_parameter("ActivationFunctionGamma")
+    cache = behaviour_digital_twin_database.get_parameter_cache()
+
+    for actionId in actionIds:
+        topic = behaviour_digital_twin_configuration.get_topic_for_action(actionId)
+        tpb_parameters = cache["TPB"].get(topic, [1.0]*3)
+        sdt_parameters = cache["SDT"].get(topic, [1.0]*4)
+        IAG = cache["IAG"].get(actionId, 0.0)
+        for participantId, tpb, sdt in behaviour_digital_twin_database.iterate_latest_scores(topic):
+            P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext = likelihoodFromScores(tpb, sdt, tpb_parameters, sdt_parameters, IAG, lambda_BI, lambda_RAI, gamma)
+            yield {"ParticipantId": participantId,
+                   "ActionId": actionId,
+                   "PredictedBehaviour": P,
+                   "BehaviouralIntention": BI,
+                   "RelativeAutonomyIndex": RAI}
+
+
+def probabilityOfBehaviour(BI, RAI, IAG, lambda_BI=None, lambda_RAI=None, gamma=None):
+    if lambda_BI is None:
+        lambda_BI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorBI")
+    if lambda_RAI is None:
+        lambda_RAI = behaviour_digital_twin_configuration.get_parameter("ImportanceFactorRAI")
+
+    beta = lambda_BI*BI + lambda_RAI*RAI - IAG
+
+    if gamma is None:
+        gamma = behaviour_digital_twin_configuration.get_parameter("ActivationFunctionGamma")
     P = 1.0 / (1 + math.exp(-beta/gamma))
     dP = P * (1.0 - P) / gamma
 
-    return P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext
-
+    return P, dP
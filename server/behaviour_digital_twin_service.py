@@ -19,27 +19,49 @@
 # DEALINGS IN THE SOFTWARE.
 
 import json
-from flask import Flask, request, jsonify
-from threading import Thread, Lock
+import logging
+import time
+from flask import Flask, Response, g, has_request_context, request, jsonify, stream_with_context
+from threading import Thread
 from time import sleep
 from datetime import datetime
 
+import behaviour_digital_twin_buffer
 import behaviour_digital_twin_database
-import behaviour_digital_twin_calibration
 import behaviour_digital_twin_configuration
+import behaviour_digital_twin_export
+import behaviour_digital_twin_jobs
+import behaviour_digital_twin_logging
+import behaviour_digital_twin_metrics
 import behaviour_digital_twin_models
 
-mutex = Lock()
+# Requests run concurrently; SQLite write transactions are serialized in
+# behaviour_digital_twin_database and calibrations run one at a time as
+# background jobs in behaviour_digital_twin_jobs.
+
+behaviour_digital_twin_logging.start()
+behaviour_digital_twin_database.initialise_database()
+for query in behaviour_digital_twin_database.check_query_plans():
+    print("Warning: query plan for " + query + " does not use an index")
+if behaviour_digital_twin_configuration.get_parameter("ActionBufferEnabled"):
+    behaviour_digital_twin_buffer.start()
 
 verbose = True
 
 
-def print_log(s):
-    print(s)
-    try:
-        behaviour_digital_twin_database.log_entry(s)
-    except BaseException as error:
-        print("Exception during logging:" + str(error))
+# Log records are queued and written by behaviour_digital_twin_logging, with
+# levels and payload sampling configured per endpoint
+def print_log(s, level=logging.INFO):
+    endpoint = request.path if has_request_context() else None
+    if (endpoint is not None) and (level >= logging.ERROR):
+        g.error = True
+    behaviour_digital_twin_logging.log(level, s, endpoint)
+    return
+
+
+def log_payload(label, data):
+    endpoint = request.path if has_request_context() else None
+    behaviour_digital_twin_logging.log_payload(label, data, endpoint)
     return
 
 
@@ -47,18 +69,21 @@ def calibration_worker():
     last = datetime(1,1,1,0,0,0,0)
     while True:
         now = datetime.now()
-        if (now.hour>=2) and (now.hour<=5) and ((now-last).hours>12):
+        if (now.hour>=2) and (now.hour<=5) and ((now-last).total_seconds()>12*3600):
             last = now
-            mutex.acquire()
             try:
-                try:
-                    print_log("Launching regular calibration " + str(now))
-                    status = behaviour_digital_twin_calibration.calibrate()
-                except BaseException as error:
-                    print_log("Exception:" + str(error))
-                print_log("Regular calibration finished" + str(datetime.now()))
-            finally:
-                mutex.release()
+                jobId = behaviour_digital_twin_jobs.start_calibration()
+                if jobId is None:
+                    print_log("Regular calibration skipped, calibration already running")
+                else:
+                    print_log("Launching regular calibration " + jobId + " " + str(now))
+                    status = behaviour_digital_twin_jobs.get_calibration_status(jobId)
+                    while status["Status"] == "Running":
+                        sleep(10)
+                        status = behaviour_digital_twin_jobs.get_calibration_status(jobId)
+                    print_log("Regular calibration " + status["Status"] + " " + str(datetime.now()))
+            except BaseException as error:
+                print_log("Exception:" + str(error), logging.ERROR)
         sleep(60*15)
 Thread(target=calibration_worker, daemon=True).start()
 
@@ -66,179 +91,483 @@ Thread(target=calibration_worker, daemon=True).start()
 app = Flask(__name__)
 
 
+# Routes catch their exceptions and answer "Fail", so a request counts as an
+# error when it logged an exception or returned a 5xx status. The duration
+# of streamed responses covers the time until streaming starts.
+@app.before_request
+def start_request_timer():
+    g.start = time.perf_counter()
+    g.error = False
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    labels = (route, request.method)
+    behaviour_digital_twin_metrics.observe("hestia_http_request_duration_seconds", labels, time.perf_counter() - g.start)
+    behaviour_digital_twin_metrics.increment("hestia_http_requests_total", (route, request.method, str(response.status_code)))
+    if g.error or (response.status_code >= 500):
+        behaviour_digital_twin_metrics.increment("hestia_http_request_errors_total", labels)
+    return response
+
+
 def authenticate(request_args, access):
     try:
         token=request_args["auth"]
         if behaviour_digital_twin_configuration.auth_token_valid(token, access):
             return True
     except BaseException as error:
-        print_log("Exception:" + str(error))
+        print_log("Exception:" + str(error), logging.ERROR)
         False
     return False
 
 
+# Without a table the admin route returns a summary of the database. With a
+# table, or "log", it streams one page of rows; Next is the cursor to pass
+# as "after" for the following page and is null on the last page.
 @app.route('/')
 def index():
-    mutex.acquire()
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "admin"):
-            return jsonify("Authentication error")
-        status = behaviour_digital_twin_database.get_status()
-        return jsonify(status)
-    finally:
-        mutex.release()
+        table = request.args.get("table")
+        if table is None:
+            return jsonify(behaviour_digital_twin_database.get_summary())
+        after = request.args.get("after", 0, type=int)
+        limit = request.args.get("limit", behaviour_digital_twin_database.dump_page_size, type=int)
+        limit = max(1, min(limit, behaviour_digital_twin_database.dump_max_page_size))
+        if table == "log":
+            lines = list(behaviour_digital_twin_logging.iterate_log(after, limit))
+            offset = lines.pop()
+            return jsonify({"Table": table, "Rows": lines, "Next": offset if len(lines) == limit else None})
+        rows = behaviour_digital_twin_database.iterate_table(table, after, limit,
+                                                             request.args.get("from", type=int),
+                                                             request.args.get("to", type=int))
+        first = next(rows, None)
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        return jsonify("Fail")
+
+    def generate():
+        yield '{"Table": ' + json.dumps(table) + ', "Rows": ['
+        count = 0
+        last = None
+        if first is not None:
+            yield json.dumps(first)
+            count = 1
+            last = first["rowid"]
+            for row in rows:
+                yield ", " + json.dumps(row)
+                count += 1
+                last = row["rowid"]
+        if count < limit:
+            last = None
+        yield '], "Next": ' + json.dumps(last) + '}'
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+@app.route('/metrics', methods=["GET"])
+def get_metrics():
+    if not authenticate(request.args, "read"):
+        return jsonify("Authentication error")
+    return Response(behaviour_digital_twin_metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/Questionnaire/', methods=["GET"])
 def get_questionnaire():
-    mutex.acquire()
+    if not authenticate(request.args, "read"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "read"):
-            return jsonify("Authentication error")
-        try:
-            input_data = request.get_json(force=True)
-            if verbose:
-                print_log("GET Questionnaire")
-                print_log("Input:" + str(input_data))
-
-            topic = input_data["Topic"]
-            language = input_data["Language"]
-
-            questionnaire = behaviour_digital_twin_configuration.get_questionnaire(topic, language)
-            if questionnaire is None:
-                output_data = "Topic or language not supported"
-            else:
-                output_data = questionnaire
-        except BaseException as error:
-            print_log("Exception:" + str(error))
-            output_data = "Fail"
-
+        input_data = request.get_json(force=True)
         if verbose:
-            print_log("Output:" + str(output_data))
-        return jsonify(output_data)
-    finally:
-        mutex.release()
+            print_log("GET Questionnaire")
+            log_payload("Input", input_data)
+
+        topic = input_data["Topic"]
+        language = input_data["Language"]
+
+        questionnaire = behaviour_digital_twin_configuration.get_questionnaire_response(topic, language)
+        if questionnaire is None:
+            output_data = "Topic or language not supported"
+        else:
+            return questionnaire_response(questionnaire)
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+
+# Sends the prepared questionnaire bytes, gzipped if the client accepts it,
+# or 304 if the client already holds the current version
+def questionnaire_response(questionnaire):
+    if request.if_none_match.contains(questionnaire["ETag"]) or request.if_none_match.contains(questionnaire["GzipETag"]):
+        response = Response(status=304)
+        etag = questionnaire["GzipETag"] if "gzip" in request.accept_encodings else questionnaire["ETag"]
+    elif "gzip" in request.accept_encodings:
+        response = Response(questionnaire["Gzip"], mimetype="application/json")
+        response.headers["Content-Encoding"] = "gzip"
+        etag = questionnaire["GzipETag"]
+    else:
+        response = Response(questionnaire["Body"], mimetype="application/json")
+        etag = questionnaire["ETag"]
+    response.set_etag(etag)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "no-cache"
+    if verbose:
+        log_payload("Output", "Questionnaire " + etag + " (" + str(response.status_code) + ")")
+    return response
+
+# Submissions that can never be stored are answered with "Invalid" rather
+# than "Fail", so that clients know not to send them again
+class InvalidSubmission(Exception):
+    pass
+
+
+def require_strings(*values):
+    for value in values:
+        if not isinstance(value, str):
+            raise TypeError("expected a string, got " + json.dumps(value))
+
+
+def parse_reply_submission(input_data):
+    try:
+        participantId = input_data["ParticipantId"]
+        questionnaireId = input_data["QuestionnaireId"]
+        replies = []
+        for reply in input_data["Replies"]:
+            questionId = reply["QuestionId"]
+            answerId = reply["AnswerId"]
+            require_strings(questionId, answerId)
+            replies.append((questionId, answerId))
+        eventId = input_data.get("EventId")
+        require_strings(participantId, questionnaireId)
+        for questionId, answerId in replies:
+            if not behaviour_digital_twin_configuration.answer_valid(questionnaireId, questionId, answerId):
+                raise ValueError("unknown answer " + json.dumps(answerId) + " to question " + json.dumps(questionId) + " of " + json.dumps(questionnaireId))
+        if eventId is not None:
+            require_strings(eventId)
+    except (KeyError, TypeError, ValueError, AttributeError) as error:
+        raise InvalidSubmission("Invalid reply submission: " + str(error))
+    return participantId, questionnaireId, replies, eventId
+
 
 @app.route('/Reply/', methods=["POST"])
 def post_reply():
-    mutex.acquire()
+    if not authenticate(request.args, "write"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "write"):
-            return jsonify("Authentication error")
-        try:
-            input_data = request.get_json(force=True)
-            if verbose:
-                print_log("POST Reply")
-                print_log("Input:" + str(input_data))
-
-            participantId = input_data["ParticipantId"]
-            questionnaireId = input_data["QuestionnaireId"]
-            replies = input_data["Replies"]
-            for reply in replies:
-                questionId = reply["QuestionId"]
-                answerId = reply["AnswerId"]
-                behaviour_digital_twin_database.report_reply(participantId, questionnaireId, questionId, answerId)
-            output_data = "Success"
-        except BaseException as error:
-            print_log("Exception:" + str(error))
-            output_data = "Fail"
+        input_data = request.get_json(force=True)
         if verbose:
-            print_log("Output:" + str(output_data))
-        return jsonify(output_data)
-    finally:
-        mutex.release()
+            print_log("POST Reply")
+            log_payload("Input", input_data)
+
+        submission = parse_reply_submission(input_data)
+        behaviour_digital_twin_database.report_replies([submission])
+        output_data = "Success"
+    except InvalidSubmission as error:
+        print_log(str(error), logging.WARNING)
+        output_data = "Invalid"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+@app.route('/Replies/', methods=["POST"])
+def post_replies():
+    if not authenticate(request.args, "write"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("POST Replies")
+            log_payload("Input", input_data)
+
+        submissions = [parse_reply_submission(submission) for submission in input_data]
+        behaviour_digital_twin_database.report_replies(submissions)
+        output_data = "Success"
+    except InvalidSubmission as error:
+        print_log(str(error), logging.WARNING)
+        output_data = "Invalid"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+def parse_action(input_data, timestamp):
+    try:
+        participantId = input_data["ParticipantId"]
+        actionId = input_data["ActionId"]
+        actionCompleted = bool(input_data["Completed"])
+        eventId = input_data.get("EventId")
+        require_strings(participantId, actionId)
+        if eventId is not None:
+            require_strings(eventId)
+    except (KeyError, TypeError, ValueError, AttributeError) as error:
+        raise InvalidSubmission("Invalid action: " + str(error))
+    return timestamp, participantId, actionId, actionCompleted, eventId
+
+
+def report_actions(actions):
+    if behaviour_digital_twin_buffer.enabled():
+        behaviour_digital_twin_buffer.submit(actions)
+    else:
+        behaviour_digital_twin_database.report_actions(actions)
+    return
+
 
 @app.route('/Action/', methods=["POST"])
 def post_action():
-    mutex.acquire()
+    if not authenticate(request.args, "write"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "write"):
-            return jsonify("Authentication error")
-        try:
-            input_data = request.get_json(force=True)
-            if verbose:
-                print_log("POST Action")
-                print_log("Input:" + str(input_data))
-
-            participantId = input_data["ParticipantId"]
-            actionId = input_data["ActionId"]
-            actionCompleted = bool(input_data["Completed"])
-            behaviour_digital_twin_database.report_action(participantId, actionId, actionCompleted)
-            output_data = "Success"
-        except BaseException as error:
-            print_log("Exception:" + str(error))
-            output_data = "Fail"
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("POST Action")
+            log_payload("Input", input_data)
+
+        timestamp = int(time.time())
+        report_actions([parse_action(input_data, timestamp)])
+        output_data = "Success"
+    except InvalidSubmission as error:
+        print_log(str(error), logging.WARNING)
+        output_data = "Invalid"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+@app.route('/Actions/', methods=["POST"])
+def post_actions():
+    if not authenticate(request.args, "write"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True)
         if verbose:
-            print_log("Output:" + str(output_data))
-        return jsonify(output_data)
-    finally:
-        mutex.release()
+            print_log("POST Actions")
+            log_payload("Input", input_data)
+
+        timestamp = int(time.time())
+        report_actions([parse_action(action, timestamp) for action in input_data])
+        output_data = "Success"
+    except InvalidSubmission as error:
+        print_log(str(error), logging.WARNING)
+        output_data = "Invalid"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
 
 @app.route('/Profile/', methods=["GET"])
 def get_profile():
-    mutex.acquire()
+    if not authenticate(request.args, "read"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "read"):
-            return jsonify("Authentication error")
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("GET Profile")
+            log_payload("Input", input_data)
+
+        participantId = input_data["ParticipantId"]
+        actionId = input_data["ActionId"]
+        P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext = behaviour_digital_twin_models.likelihoodOfBehaviour(actionId, participantId)
+        output_data = {
+            "BehaviouralIntention": BI,
+            "RelativeAutonomyIndex": RAI,
+            "AttitudeTowardsBehaviour": A,
+            "SubjectiveNorms": SN,
+            "PerceivedBehaviouralControl": PBC,
+            "PredictedBehaviour": P
+        }
+        B = behaviour_digital_twin_database.get_action_response_rate(participantId,actionId,
+                                                                     input_data.get("ResponseRateWindowDays"),
+                                                                     input_data.get("ResponseRateHalfLifeDays"))
+        if B is not None:
+            output_data["ActualBehaviour"] = B
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+@app.route('/Profiles/', methods=["GET"])
+def get_profiles():
+    if not authenticate(request.args, "read"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("GET Profiles")
+            log_payload("Input", input_data)
+
+        participantIds = input_data["ParticipantIds"]
+        actionIds = input_data["ActionIds"]
+        likelihoods = behaviour_digital_twin_models.likelihoodsOfBehaviour(actionIds, participantIds)
+        rates = behaviour_digital_twin_database.get_action_response_rates(participantIds, actionIds,
+                                                                          input_data.get("ResponseRateWindowDays"),
+                                                                          input_data.get("ResponseRateHalfLifeDays"))
+        output_data = []
+        for actionId in actionIds:
+            for participantId in participantIds:
+                profile = {"ParticipantId": participantId, "ActionId": actionId}
+                likelihood = likelihoods[(actionId, participantId)]
+                if likelihood is None:
+                    profile["Error"] = "No replies"
+                else:
+                    P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext = likelihood
+                    profile["BehaviouralIntention"] = BI
+                    profile["RelativeAutonomyIndex"] = RAI
+                    profile["AttitudeTowardsBehaviour"] = A
+                    profile["SubjectiveNorms"] = SN
+                    profile["PerceivedBehaviouralControl"] = PBC
+                    profile["PredictedBehaviour"] = P
+                B = rates.get((participantId, actionId))
+                if B is not None:
+                    profile["ActualBehaviour"] = B
+                output_data.append(profile)
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
+
+@app.route('/Export/', methods=["GET"])
+def get_export():
+    if not authenticate(request.args, "read"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("GET Export")
+            log_payload("Input", input_data)
+
+        format = input_data.get("Format", "NDJSON")
+        if format not in behaviour_digital_twin_export.export_formats:
+            raise ValueError("Unknown format " + str(format))
+        actionIds = behaviour_digital_twin_export.get_export_actions(input_data.get("ActionId"), input_data.get("Topic"))
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        return jsonify("Fail")
+
+    def generate():
         try:
-            input_data = request.get_json(force=True)
-            if verbose:
-                print_log("GET Profile")
-                print_log("Input:" + str(input_data))
-
-            participantId = input_data["ParticipantId"]
-            actionId = input_data["ActionId"]
-            P, dP, BI, RAI, A, SN, PBC, Rint, Rid, Rintro, Rext = behaviour_digital_twin_models.likelihoodOfBehaviour(actionId, participantId)
-            output_data = {
-                "BehaviouralIntention": BI,
-                "RelativeAutonomyIndex": RAI,
-                "AttitudeTowardsBehaviour": A,
-                "SubjectiveNorms": SN,
-                "PerceivedBehaviouralControl": PBC,
-                "PredictedBehaviour": P
-            }
-            B = behaviour_digital_twin_database.get_action_response_rate(participantId,actionId)
-            if B is not None:
-                output_data["ActualBehaviour"] = B
+            for line in behaviour_digital_twin_export.export(actionIds, format):
+                yield line
         except BaseException as error:
-            print_log("Exception:" + str(error))
-            output_data = "Fail"
-        if verbose:
-            print_log("Output:" + str(output_data))
-        return jsonify(output_data)
-    finally:
-        mutex.release()
+            print_log("Exception during export:" + str(error), logging.ERROR)
+            raise
+
+    if format == "CSV":
+        mimetype = "text/csv"
+    else:
+        mimetype = "application/x-ndjson"
+    return Response(stream_with_context(generate()), mimetype=mimetype)
 
 @app.route('/Calibrate/', methods=["POST"])
 def post_calibrate():
-    mutex.acquire()
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "admin"):
-            return jsonify("Authentication error")
-        try:
-            if verbose:
-                print_log("POST Calibrate")
-            status = behaviour_digital_twin_calibration.calibrate()
-        except BaseException as error:
-            print_log("Exception:" + str(error))
-            status = "Fail"
         if verbose:
-            print_log("Output:" + str(status))
-        return jsonify(status)
-    finally:
-        mutex.release()
+            print_log("POST Calibrate")
+        jobId = behaviour_digital_twin_jobs.start_calibration()
+        if jobId is None:
+            status = "Calibration already running"
+        else:
+            status = {"JobId": jobId}
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        status = "Fail"
+    if verbose:
+        log_payload("Output", status)
+    return jsonify(status)
+
+@app.route('/Calibrate/', methods=["GET"])
+def get_calibrate():
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True, silent=True)
+        if verbose:
+            print_log("GET Calibrate")
+            log_payload("Input", input_data)
+
+        jobId = None
+        if input_data is not None:
+            jobId = input_data.get("JobId")
+        status = behaviour_digital_twin_jobs.get_calibration_status(jobId)
+        if status is None:
+            status = "Unknown calibration job"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        status = "Fail"
+    if verbose:
+        log_payload("Output", status)
+    return jsonify(status)
+
+@app.route('/Calibrate/Cancel/', methods=["POST"])
+def post_calibrate_cancel():
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
+    try:
+        input_data = request.get_json(force=True)
+        if verbose:
+            print_log("POST Calibrate Cancel")
+            log_payload("Input", input_data)
+
+        if behaviour_digital_twin_jobs.cancel_calibration(input_data["JobId"]):
+            output_data = "Success"
+        else:
+            output_data = "Unknown calibration job"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
 
 @app.route('/Delete/', methods=["POST"])
 def post_delete():
-    mutex.acquire()
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
+    if verbose:
+        print_log("POST Delete")
+    # Buffered actions would otherwise be written after the deletion
+    if behaviour_digital_twin_buffer.enabled():
+        behaviour_digital_twin_buffer.discard()
+    behaviour_digital_twin_database.delete_all_data()
+    if verbose:
+        print_log("Output:" + "Database deleted")
+    return jsonify("Database deleted")
+
+
+@app.route('/Rebuild/', methods=["POST"])
+def post_rebuild():
+    if not authenticate(request.args, "admin"):
+        return jsonify("Authentication error")
     try:
-        if not authenticate(request.args, "admin"):
-            return jsonify("Authentication error")
         if verbose:
-            print_log("POST Delete")
-        behaviour_digital_twin_database.delete_all_data()
-        if verbose:
-            print_log("Output:" + "Database deleted")
-        return jsonify("Database deleted")
-    finally:
-        mutex.release()
+            print_log("POST Rebuild")
+        behaviour_digital_twin_database.rebuild_latest_scores()
+        behaviour_digital_twin_database.rebuild_action_counts()
+        behaviour_digital_twin_database.rebuild_action_buckets()
+        output_data = "Success"
+    except BaseException as error:
+        print_log("Exception:" + str(error), logging.ERROR)
+        output_data = "Fail"
+    if verbose:
+        log_payload("Output", output_data)
+    return jsonify(output_data)
@@ -0,0 +1,361 @@
+# Copyright 2023 Munster Technological University, Ireland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the “Software”),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED “AS IS”, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+import behaviour_digital_twin_calibration
+import behaviour_digital_twin_configuration
+import behaviour_digital_twin_database
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# A training snapshot holds the calibration inputs of every topic as fixed
+# width little-endian arrays, so that calibration runs can map the file and
+# use the arrays in place instead of reading the database. The file starts
+# with the magic bytes and the length of a JSON header describing the
+# arrays; every array is aligned to 64 bytes after the header. Per topic the
+# participant of every row is an index into the scores, which are stored
+# once per participant, and into its id dictionary, which is stored as
+# utf-8 bytes with int64 offsets.
+snapshot_magic = b"HSTSNAP1"
+snapshot_version = 3
+snapshot_alignment = 64
+snapshot_arrays = {"ActionIndex": "<i8",
+                   "Rate": "<f8",
+                   "Scores": "<f8",
+                   "N": "<f8",
+                   "n": "<f8",
+                   "Participant": "<i8",
+                   "ParticipantIdOffsets": "<i8",
+                   "ParticipantIdBytes": "u1"}
+
+
+def aligned(offset):
+    return (offset + snapshot_alignment - 1) // snapshot_alignment * snapshot_alignment
+
+
+# Builds the arrays of a topic in the same order as load_topic_data. Pairs of
+# participants without scores are left out and counted, as in
+# load_topic_data. The fingerprint is computed from the scores of every pair,
+# so that it matches the one of the data loaded from the database.
+def build_topic_arrays(topic, actions, N, n, scores):
+    participants = {}
+    participant_scores = []
+    columns = {"ActionIndex": [], "Rate": [], "Scores": [], "N": [], "n": [], "Participant": []}
+    skipped = 0
+    for a, action in enumerate(actions):
+        for participant in N[action]:
+            NN = N[action][participant]
+            nn = n[action][participant]
+            if (NN>1) and (nn>0) and (nn<NN):
+                if participant not in scores:
+                    skipped += 1
+                    continue
+                columns["ActionIndex"].append(a)
+                columns["Rate"].append(float(nn)/float(NN))
+                columns["Scores"].append(scores[participant])
+                columns["N"].append(NN)
+                columns["n"].append(nn)
+                if participant not in participants:
+                    participants[participant] = len(participants)
+                    participant_scores.append(scores[participant])
+                columns["Participant"].append(participants[participant])
+
+    fingerprint = behaviour_digital_twin_calibration.data_fingerprint({"Actions": list(actions),
+                                                                        "ActionIndex": columns["ActionIndex"],
+                                                                        "Rate": columns["Rate"],
+                                                                        "Scores": columns["Scores"]})
+    behaviour_digital_twin_calibration.report_skipped_pairs(topic, skipped)
+    ids = [participant.encode("utf-8") for participant in participants]
+    offsets = [0]
+    for id in ids:
+        offsets.append(offsets[-1] + len(id))
+    arrays = {"ActionIndex": numpy.array(columns["ActionIndex"], dtype="<i8"),
+              "Rate": numpy.array(columns["Rate"], dtype="<f8"),
+              "Scores": numpy.array(participant_scores, dtype="<f8").reshape(-1, 7),
+              "N": numpy.array(columns["N"], dtype="<f8"),
+              "n": numpy.array(columns["n"], dtype="<f8"),
+              "Participant": numpy.array(columns["Participant"], dtype="<i8"),
+              "ParticipantIdOffsets": numpy.array(offsets, dtype="<i8"),
+              "ParticipantIdBytes": numpy.frombuffer(b"".join(ids), dtype="u1")}
+    return arrays, fingerprint, skipped
+
+
+def load_topic_scores(topic):
+    scores = {}
+    for participant, tpb, sdt in behaviour_digital_twin_database.iterate_latest_scores(topic):
+        scores[participant] = behaviour_digital_twin_calibration.section_scores(tpb, sdt)
+    return scores
+
+
+# Describes what the arrays of all topics are built from: the last row of
+# the actions and replies tables, the scoring rules, the topics of actions
+# and questionnaires, and the response rate window, which depends on the day
+# when it is limited or decays
+def get_source():
+    registry = behaviour_digital_twin_configuration.get_registry()
+    topics = json.dumps([sorted(registry["TopicForAction"].items()),
+                         registry["DefaultTopic"],
+                         sorted([list(key), sorted(registry["QuestionnaireIds"][key])] for key in registry["QuestionnaireIds"])])
+    today, first_day, half_life_days = behaviour_digital_twin_database.get_response_rate_window()
+    weighted = (first_day > 0) or (half_life_days > 0)
+    return {"Markers": {table: behaviour_digital_twin_database.get_history_marker(table) for table in ["actions", "replies"]},
+            "Scoring": behaviour_digital_twin_configuration.get_scoring_fingerprint(),
+            "Topics": hashlib.sha256(topics.encode()).hexdigest(),
+            "ResponseRates": [first_day, half_life_days, today if weighted else None]}
+
+
+# Returns the topics whose arrays may have changed since the previous source
+# was recorded, with the actions that are new to them, or None if none of
+# the previous arrays can be reused. Only the rows appended to the actions
+# and replies tables since then are read.
+def get_changed_topics(previous, current):
+    for key in ["Scoring", "Topics", "ResponseRates"]:
+        if previous[key] != current[key]:
+            return None
+    for table in current["Markers"]:
+        if not behaviour_digital_twin_database.history_continues(table, previous["Markers"][table]):
+            return None
+
+    changed = {}
+    for action in behaviour_digital_twin_database.get_values_since("actions", "actionId", previous["Markers"]["actions"]):
+        changed.setdefault(behaviour_digital_twin_configuration.get_topic_for_action(action), []).append(action)
+    for questionnaire in behaviour_digital_twin_database.get_values_since("replies", "questionnaireId", previous["Markers"]["replies"]):
+        for model, topic in behaviour_digital_twin_configuration.get_models_and_topics_for_questionnaireId(questionnaire):
+            changed.setdefault(topic, [])
+    return changed
+
+
+def read_header(f):
+    start = f.read(16)
+    if (len(start) != 16) or (start[:8] != snapshot_magic):
+        raise ValueError("Not a training snapshot")
+    length = struct.unpack("<Q", start[8:])[0]
+    header = json.loads(f.read(length).decode("utf-8"))
+    if header["Version"] != snapshot_version:
+        raise ValueError("Unsupported snapshot version " + str(header["Version"]))
+    header["DataOffset"] = aligned(16 + length)
+    return header
+
+
+def map_arrays(buffer, data_offset, layout):
+    arrays = {}
+    for name in layout:
+        entry = layout[name]
+        count = 1
+        for size in entry["Shape"]:
+            count *= size
+        arrays[name] = numpy.frombuffer(buffer, dtype=entry["DType"], count=count,
+                                        offset=data_offset + entry["Offset"]).reshape(entry["Shape"])
+    return arrays
+
+
+def write_snapshot(path, topics, source):
+    header = {"Version": snapshot_version, "Created": int(time.time()), "Source": source, "Topics": {}}
+    offset = 0
+    order = []
+    for topic in topics:
+        layout = {}
+        for name in snapshot_arrays:
+            # Arrays reused from an older file are converted to the current
+            # dtype, so that the layout always describes the bytes written
+            array = numpy.ascontiguousarray(topics[topic]["Arrays"][name], dtype=snapshot_arrays[name])
+            layout[name] = {"Offset": offset, "DType": snapshot_arrays[name], "Shape": list(array.shape)}
+            order.append((offset, array))
+            offset = aligned(offset + array.nbytes)
+        header["Topics"][topic] = {"Actions": topics[topic]["Actions"],
+                                   "Pairs": int(topics[topic]["Arrays"]["Rate"].shape[0]),
+                                   "Fingerprint": topics[topic]["Fingerprint"],
+                                   "SkippedPairs": topics[topic]["SkippedPairs"],
+                                   "Arrays": layout}
+    content = json.dumps(header).encode("utf-8")
+    data_offset = aligned(16 + len(content))
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(snapshot_magic + struct.pack("<Q", len(content)) + content)
+        for array_offset, array in order:
+            f.write(b"\0" * (data_offset + array_offset - f.tell()))
+            f.write(array.tobytes())
+        f.write(b"\0" * (data_offset + offset - f.tell()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+# Writes the snapshot, rebuilding only the topics that gained actions or
+# replies since the existing file was written. Only the counts of the
+# actions of those topics and their scores are read. Returns the number of
+# pairs, of skipped pairs and whether the arrays were reused for every topic.
+def refresh_snapshot(path):
+    if numpy is None:
+        raise RuntimeError("Training snapshots require NumPy")
+
+    previous = None
+    if os.path.exists(path):
+        try:
+            previous = open_snapshot(path)
+        except (ValueError, OSError, KeyError) as error:
+            print("Ignoring existing snapshot:" + str(error))
+
+    topics = {}
+    status = {}
+    arrays = None
+    try:
+        behaviour_digital_twin_database.ensure_latest_scores()
+        with behaviour_digital_twin_database.snapshot():
+            source = get_source()
+            changed = None
+            if previous is not None:
+                changed = get_changed_topics(previous["Header"]["Source"], source)
+
+            if changed is None:
+                N,n = behaviour_digital_twin_database.get_all_action_response_rates()
+                actions_for_topic = behaviour_digital_twin_calibration.group_actions_by_topic(N)
+            else:
+                actions_for_topic = {}
+                for topic in previous["Header"]["Topics"]:
+                    actions_for_topic[topic] = previous["Header"]["Topics"][topic]["Actions"]
+                for topic in changed:
+                    known = set(actions_for_topic.get(topic, []))
+                    actions_for_topic[topic] = actions_for_topic.get(topic, []) + [action for action in changed[topic] if action not in known]
+                actionIds = [action for topic in changed for action in actions_for_topic[topic]]
+                N,n = behaviour_digital_twin_database.get_all_action_response_rates(actionIds=actionIds)
+
+            for topic in actions_for_topic:
+                if (changed is not None) and (topic not in changed):
+                    entry = previous["Header"]["Topics"][topic]
+                    arrays = map_arrays(previous["Buffer"], previous["Header"]["DataOffset"], entry["Arrays"])
+                    fingerprint = entry["Fingerprint"]
+                    skipped = entry["SkippedPairs"]
+                    actions = entry["Actions"]
+                    reused = True
+                else:
+                    actions = [action for action in actions_for_topic[topic] if action in N]
+                    if len(actions) == 0:
+                        continue
+                    arrays, fingerprint, skipped = build_topic_arrays(topic, actions, N, n, load_topic_scores(topic))
+                    reused = False
+                topics[topic] = {"Actions": list(actions), "Arrays": arrays, "Fingerprint": fingerprint, "SkippedPairs": skipped}
+                status[topic] = {"Pairs": int(arrays["Rate"].shape[0]), "SkippedPairs": skipped, "Reused": reused}
+        write_snapshot(path, topics, source)
+    finally:
+        topics = arrays = None
+        if previous is not None:
+            close_snapshot(previous)
+    return status
+
+
+def open_snapshot(path):
+    f = open(path, "rb")
+    try:
+        header = read_header(f)
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    return {"Header": header, "Buffer": buffer}
+
+
+def close_snapshot(snapshot):
+    try:
+        snapshot["Buffer"].close()
+    except BufferError:
+        pass
+
+
+# Maps the snapshot read-only and returns the calibration inputs of every
+# topic, as expected by calibrate(topic_data=...). The arrays refer to the
+# mapped file directly; the mapping stays open as long as they are in use.
+def load_snapshot(path):
+    if numpy is None:
+        raise RuntimeError("Training snapshots require NumPy")
+    snapshot = open_snapshot(path)
+    topic_data = {}
+    for topic in snapshot["Header"]["Topics"]:
+        entry = snapshot["Header"]["Topics"][topic]
+        arrays = map_arrays(snapshot["Buffer"], snapshot["Header"]["DataOffset"], entry["Arrays"])
+        topic_data[topic] = {"Actions": entry["Actions"],
+                             "ActionIndex": arrays["ActionIndex"],
+                             "Rate": arrays["Rate"],
+                             "Scores": arrays["Scores"],
+                             "Participant": arrays["Participant"],
+                             "Fingerprint": entry["Fingerprint"]}
+    return topic_data
+
+
+def get_participant_ids(path, topic):
+    snapshot = open_snapshot(path)
+    arrays = map_arrays(snapshot["Buffer"], snapshot["Header"]["DataOffset"], snapshot["Header"]["Topics"][topic]["Arrays"])
+    offsets = arrays["ParticipantIdOffsets"]
+    content = arrays["ParticipantIdBytes"].tobytes()
+    return [content[offsets[i]:offsets[i+1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+
+def parse_setting(setting):
+    key, _, value = setting.partition("=")
+    if key not in behaviour_digital_twin_configuration.parameters_file:
+        raise ValueError("Unknown parameter " + key)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write training snapshots and calibrate from them")
+    parser.add_argument("command", choices=["refresh", "calibrate"])
+    parser.add_argument("--file", default=behaviour_digital_twin_configuration.get_parameter("CalibrationSnapshotFile"),
+                        help="snapshot file")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a calibration parameter for this run, e.g. ImportanceFactorBI=2.0")
+    parser.add_argument("--publish", action="store_true", help="publish the fitted parameters to the database")
+    args = parser.parse_args()
+
+    if args.command == "refresh":
+        start = time.perf_counter()
+        status = refresh_snapshot(args.file)
+        print(json.dumps({"Topics": status, "Seconds": time.perf_counter() - start}, indent=1))
+    else:
+        for setting in args.set:
+            try:
+                key, value = parse_setting(setting)
+            except ValueError as error:
+                parser.error(str(error))
+            behaviour_digital_twin_configuration.parameters_file[key] = value
+        result = behaviour_digital_twin_calibration.calibrate(topic_data=load_snapshot(args.file), publish=args.publish)
+        json.dump(result, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()